@@ -0,0 +1,167 @@
+"""Build a synthetic ugit repository of a given shape for the benchmarks.
+
+Prints a JSON description of what was built, which run.py relies on.
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import string
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LINE_LENGTH = 64
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='directory to create the repository in, must not exist')
+    add_shape_arguments(parser)
+    parser.add_argument('--ugit', default=ROOT, help='checkout of ugit to build the repository with')
+    return parser.parse_args(argv)
+
+
+def add_shape_arguments(parser):
+    shape = parser.add_argument_group('repository shape')
+    shape.add_argument('--files', type=int, default=1000, help='files in the first commit')
+    shape.add_argument('--depth', type=int, default=3, help='maximum directory nesting')
+    shape.add_argument('--fanout', type=int, default=4, help='subdirectories per directory')
+    shape.add_argument('--file-size', type=int, default=2048, help='median file size in bytes')
+    shape.add_argument('--size-spread', type=float, default=1.0,
+                       help='sigma of the log-normal file size distribution, 0 for equal sizes')
+    shape.add_argument('--commits', type=int, default=50, help='commits made after the first one')
+    shape.add_argument('--changes', type=int, default=5, help='files modified by each commit')
+    shape.add_argument('--branches', type=int, default=2, help='topic branches besides master')
+    shape.add_argument('--branchiness', type=float, default=0.2,
+                       help='probability of switching branch before each commit')
+    shape.add_argument('--seed', type=int, default=0)
+
+
+def shape_argv(args) -> list[str]:
+    """Command line options reproducing the shape options of parsed arguments"""
+    parser = argparse.ArgumentParser()
+    add_shape_arguments(parser)
+    return [argument for name in vars(parser.parse_args([]))
+            for argument in (f'--{name.replace("_", "-")}', str(getattr(args, name)))]
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    assert not os.path.exists(args.path), f'{args.path} already exists'
+    # Imported late so the repository can be built by any version of ugit
+    sys.path.insert(0, os.path.abspath(args.ugit))
+    from ugit import base, data
+
+    os.makedirs(args.path)
+    os.chdir(args.path)
+    rng = random.Random(args.seed)
+    generator = _Generator(args, rng)
+    # ugit reports merges on stdout, which is reserved for the description
+    with data.change_git_dir('.'), contextlib.redirect_stdout(io.StringIO()):
+        base.init()
+        paths = [generator.new_path() for _ in range(args.files)]
+        for path in paths:
+            generator.write(path, generator.new_content())
+        base.add(['.'])
+        base.commit('Initial commit')
+
+        branches = ['master']
+        merges = 0
+        for i in range(args.commits):
+            branch = base.get_branch_name()
+            if args.branches and rng.random() < args.branchiness:
+                topics = [name for name in branches if name != 'master']
+                if branch != 'master':
+                    # Come back to master, bringing the topic along half of the time
+                    base.checkout('master')
+                    if rng.random() < 0.5:
+                        base.merge(base.get_oid(branch))
+                        # Nothing to commit after a fast-forward
+                        if data.get_ref('MERGE_HEAD').value:
+                            base.add(['.'])
+                            base.commit(f'Merge {branch}')
+                            merges += 1
+                elif len(topics) < args.branches:
+                    branch = f'topic-{len(topics) + 1}'
+                    base.create_branch(branch, base.get_oid('@'))
+                    branches.append(branch)
+                    base.checkout(branch)
+                else:
+                    base.checkout(rng.choice(topics))
+
+            for _ in range(args.changes):
+                if rng.random() < 0.1:
+                    path = generator.new_path()
+                    paths.append(path)
+                else:
+                    path = rng.choice(paths)
+                # Files added on another branch are added again on this one
+                generator.write(path, generator.edit(path) if os.path.exists(path) else generator.new_content())
+            base.add(['.'])
+            base.commit(f'Change {i + 1}')
+
+        base.checkout('master')
+        tracked = base.get_index_tree()
+
+    json.dump({
+        'path': os.path.abspath('.'),
+        'files': len(tracked),
+        'commits': args.commits + merges + 1,
+        'merges': merges,
+        'branches': branches,
+        'bytes': sum(os.path.getsize(path) for path in tracked),
+        'shape': {name: value for name, value in vars(args).items() if name not in ('path', 'ugit')},
+    }, sys.stdout, indent=2)
+    print()
+
+
+class _Generator:
+    def __init__(self, args, rng: random.Random):
+        self.args = args
+        self.rng = rng
+        self._paths = set()
+
+    def new_path(self):
+        while True:
+            depth = self.rng.randint(0, self.args.depth)
+            dirs = [f'dir{self.rng.randrange(self.args.fanout)}' for _ in range(depth)]
+            path = '/'.join(dirs + [f'file{self.rng.randrange(10 * self.args.files + 10)}.txt'])
+            if path not in self._paths:
+                self._paths.add(path)
+                return path
+
+    def new_content(self) -> str:
+        size = self.args.file_size * math.exp(self.rng.gauss(0, self.args.size_spread))
+        return ''.join(self._line() for _ in range(max(1, round(size / LINE_LENGTH))))
+
+    def edit(self, path) -> str:
+        # Replace, insert or delete a few lines, like a real change would
+        with open(path) as f:
+            lines = f.read().splitlines(keepends=True)
+        for _ in range(self.rng.randint(1, 3)):
+            position = self.rng.randrange(len(lines) + 1)
+            action = self.rng.random()
+            if action < 0.5 and position < len(lines):
+                lines[position] = self._line()
+            elif action < 0.8 or len(lines) < 2:
+                lines.insert(position, self._line())
+            elif position < len(lines):
+                del lines[position]
+        return ''.join(lines)
+
+    def write(self, path, content):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _line(self):
+        return ''.join(self.rng.choices(string.ascii_lowercase + ' ', k=LINE_LENGTH - 1)) + '\n'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+"""Time ugit commands on synthetic repositories.
+
+Every scenario runs ugit in a fresh copy of a repository built by generate.py,
+as its own process so that its peak memory can be measured. Results are printed
+as a table and optionally written as JSON, to compare runs of different versions:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --ugit ../ugit-new --output after.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import string
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Objects are counted from the files themselves, as the versions compared may not
+# share an API: loose objects are objects/<oid> in the first versions and
+# objects/<2 hex>/<38 hex> later. A pack index starts with a signature, a version
+# and 256 cumulative counts by first oid byte, followed by the sorted binary oids.
+_IDX_HEADER = struct.Struct('>4sI256I')
+_OID_SIZE = 20
+
+SCENARIOS = {}
+# Scenarios using a topic branch, skipped for repositories generated without
+NEEDS_BRANCHES = set()
+
+
+def scenario(name, needs_branches=False):
+    def register(setup):
+        SCENARIOS[name] = setup
+        if needs_branches:
+            NEEDS_BRANCHES.add(name)
+        return setup
+    return register
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f'scenarios to run (default: all of {", ".join(SCENARIOS)})')
+    parser.add_argument('--ugit', default=ROOT, help='checkout of ugit to benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each scenario')
+    parser.add_argument('--touch', type=int, default=10, help='files modified before add, status, diff...')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--keep', action='store_true', help="don't delete the repositories afterwards")
+    parser.add_argument('--work-dir', help='directory for the repositories (default: a temporary one)')
+    generate.add_shape_arguments(parser)
+    args = parser.parse_args()
+    for name in args.scenarios:
+        assert name in SCENARIOS, f'Unknown scenario {name}'
+    return args
+
+
+def main():
+    args = parse_args()
+    args.ugit = os.path.abspath(args.ugit)
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix='ugit_bench_'))
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        template = os.path.join(work_dir, 'template')
+        if os.path.exists(template):
+            shutil.rmtree(template)
+        repo = json.loads(subprocess.run(
+            [sys.executable, generate.__file__, template, '--ugit', args.ugit, *generate.shape_argv(args)],
+            check=True, stdout=subprocess.PIPE).stdout)
+        print(f'Repository: {repo["files"]} files, {repo["bytes"]} bytes, {repo["commits"]} commits, '
+              f'{len(repo["branches"])} branches', file=sys.stderr)
+
+        results = {}
+        for name in args.scenarios or SCENARIOS:
+            if name in NEEDS_BRANCHES and len(repo['branches']) < 2:
+                print(f'Skipping {name}: it needs a repository with branches, pass --branches', file=sys.stderr)
+                continue
+            results[name] = _run_scenario(name, args, repo, work_dir)
+            _print_result(name, results[name])
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'ugit': _describe_version(args.ugit),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'repository': {key: value for key, value in repo.items() if key != 'path'},
+                'touch': args.touch,
+                'results': results,
+            }, f, indent=2)
+            f.write('\n')
+
+
+class _Run:
+    """A fresh copy of the repository for one run of a scenario"""
+
+    def __init__(self, args, repo, work_dir):
+        self.args = args
+        self.repo = repo
+        self.work_dir = work_dir
+        self.path = self.copy('repo')
+        self.remote = None
+
+    def copy(self, name):
+        path = os.path.join(self.work_dir, name)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        shutil.copytree(self.repo['path'], path, symlinks=True)
+        return path
+
+    def ugit(self, *argv, cwd=None) -> str:
+        return subprocess.run(_ugit_command(argv), cwd=cwd or self.path, env=_env(self.args.ugit),
+                              check=True, stdout=subprocess.PIPE, text=True).stdout
+
+    def touch(self, path=None):
+        # Appending keeps the sizes and so the diff and hashing work realistic
+        path = path or self.path
+        files = sorted(_iter_files(path))
+        step = max(1, len(files) // self.args.touch)
+        for file in files[::step][:self.args.touch]:
+            with open(os.path.join(path, file), 'a') as f:
+                f.write(f'benchmark change {time.time_ns()}\n')
+
+    def commit_on(self, path):
+        self.touch(path)
+        self.ugit('add', '.', cwd=path)
+        self.ugit('commit', '-m', 'Benchmark commit', cwd=path)
+
+    def repositories(self) -> list[str]:
+        return [self.path] + ([self.remote] if self.remote else [])
+
+
+@scenario('add')
+def _add(run: _Run):
+    run.touch()
+    return ['add', '.']
+
+
+@scenario('write-tree')
+def _write_tree(run: _Run):
+    run.touch()
+    run.ugit('add', '.')
+    return ['write-tree']
+
+
+@scenario('commit')
+def _commit(run: _Run):
+    run.touch()
+    run.ugit('add', '.')
+    return ['commit', '-m', 'Benchmark commit']
+
+
+@scenario('status')
+def _status(run: _Run):
+    run.touch()
+    return ['status']
+
+
+@scenario('diff')
+def _diff(run: _Run):
+    run.touch()
+    return ['diff']
+
+
+@scenario('log')
+def _log(run: _Run):
+    return ['log']
+
+
+@scenario('show')
+def _show(run: _Run):
+    return ['show']
+
+
+@scenario('checkout', needs_branches=True)
+def _checkout(run: _Run):
+    return ['checkout', run.repo['branches'][-1]]
+
+
+@scenario('merge', needs_branches=True)
+def _merge(run: _Run):
+    # A change on master keeps the merge from being a fast-forward
+    run.commit_on(run.path)
+    return ['merge', run.repo['branches'][-1]]
+
+
+@scenario('fetch')
+def _fetch(run: _Run):
+    run.remote = run.path
+    run.path = os.path.join(run.work_dir, 'empty')
+    if os.path.exists(run.path):
+        shutil.rmtree(run.path)
+    os.makedirs(run.path)
+    run.ugit('init')
+    return ['fetch', run.remote]
+
+
+@scenario('fetch-incremental')
+def _fetch_incremental(run: _Run):
+    run.remote = run.copy('remote')
+    run.commit_on(run.remote)
+    return ['fetch', run.remote]
+
+
+@scenario('push')
+def _push(run: _Run):
+    run.remote = run.copy('remote')
+    run.commit_on(run.path)
+    return ['push', run.remote, 'master']
+
+
+def _run_scenario(name, args, repo, work_dir) -> dict:
+    runs = []
+    for _ in range(args.repeat):
+        run = _Run(args, repo, work_dir)
+        command = SCENARIOS[name](run)
+        objects_before = _count_objects(run)
+        files_before = _snapshot(run)
+
+        start = time.perf_counter()
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(_ugit_command(command), cwd=run.path, env=_env(args.ugit),
+                                       stdout=subprocess.DEVNULL, stderr=stderr)
+            # wait4 gives the resource usage of this child alone
+            _, status, usage = os.wait4(process.pid, 0)
+            wall = time.perf_counter() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+            stderr.seek(0)
+            assert process.returncode == 0, f'{name} failed: {stderr.read().decode()}'
+
+        files_after = _snapshot(run)
+        runs.append({
+            'wall': wall,
+            'user': usage.ru_utime,
+            'system': usage.ru_stime,
+            # Kilobytes on Linux, bytes on macOS
+            'max_rss_kb': usage.ru_maxrss // (1024 if sys.platform == 'darwin' else 1),
+            'objects_written': _count_objects(run) - objects_before,
+            'files_touched': sum(files_before.get(path) != stat for path, stat in files_after.items()) +
+                             len(files_before.keys() - files_after.keys()),
+        })
+
+    walls = [r['wall'] for r in runs]
+    return {
+        'command': command,
+        'wall_min': min(walls),
+        'wall_median': statistics.median(walls),
+        'max_rss_kb': max(r['max_rss_kb'] for r in runs),
+        'objects_written': runs[-1]['objects_written'],
+        'files_touched': runs[-1]['files_touched'],
+        'runs': runs,
+    }
+
+
+def _count_objects(run: _Run) -> int:
+    return sum(len(_list_objects(os.path.join(path, '.ugit', 'objects'))) for path in run.repositories())
+
+
+def _list_objects(objects_dir) -> set[str]:
+    oids = set()
+    for root, dirnames, filenames in os.walk(objects_dir):
+        dirname = os.path.relpath(root, objects_dir)
+        for filename in filenames:
+            oid = filename if dirname == '.' else dirname + filename
+            if len(oid) == 2 * _OID_SIZE and all(c in string.hexdigits for c in oid):
+                oids.add(oid)
+            elif dirname == 'pack' and filename.endswith('.idx'):
+                oids.update(_read_pack_index(os.path.join(root, filename)))
+    return oids
+
+
+def _read_pack_index(path) -> list[str]:
+    with open(path, 'rb') as f:
+        header = f.read(_IDX_HEADER.size)
+        count = _IDX_HEADER.unpack(header)[-1]
+        raw = f.read(count * _OID_SIZE)
+    return [raw[i:i + _OID_SIZE].hex() for i in range(0, len(raw), _OID_SIZE)]
+
+
+def _snapshot(run: _Run) -> dict[str, tuple[int, int, int]]:
+    # Working trees and repositories on both ends, by what a write changes
+    snapshot = {}
+    for path in run.repositories():
+        for root, _, filenames in os.walk(path):
+            for filename in filenames:
+                full_path = os.path.join(root, filename)
+                stat = os.lstat(full_path)
+                snapshot[full_path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    return snapshot
+
+
+def _iter_files(path):
+    for root, dirnames, filenames in os.walk(path):
+        dirnames[:] = [name for name in dirnames if name != '.ugit']
+        for filename in filenames:
+            yield os.path.relpath(os.path.join(root, filename), path)
+
+
+def _ugit_command(argv) -> list[str]:
+    return [sys.executable, '-c', 'from ugit.cli import main; main()', *argv]
+
+
+def _env(ugit) -> dict[str, str]:
+    return {**os.environ, 'PYTHONPATH': ugit}
+
+
+def _describe_version(ugit) -> str | None:
+    result = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ugit,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return result.stdout.strip() or None
+
+
+def _print_result(name, result):
+    print(f'{name:<18} {result["wall_min"] * 1000:9.1f} ms  {result["wall_median"] * 1000:9.1f} ms median  '
+          f'{result["max_rss_kb"] / 1024:7.1f} MB  {result["objects_written"]:6} objects  '
+          f'{result["files_touched"]:6} files')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import random
+
+import pytest
+
+from ugit import delta
+
+
+def _random_bytes(size, seed):
+    return random.Random(seed).randbytes(size)
+
+
+@pytest.mark.parametrize('base, target', [
+    (b'', b''),
+    (b'', b'new content'),
+    (b'old content', b''),
+    (b'short', b'short'),
+    (b'x' * 1000, b'x' * 1000),
+    (_random_bytes(5000, 1), _random_bytes(5000, 1)),
+    (_random_bytes(5000, 1), _random_bytes(3000, 2)),
+    (b'a' * 300, b'b' * 300),
+])
+def test_round_trip(base, target):
+    assert delta.apply_delta(base, delta.create_delta(base, target)) == target
+
+
+def test_identical_is_copied():
+    base = _random_bytes(10_000, 3)
+    assert len(delta.create_delta(base, base)) < 20
+
+
+def test_different_is_inserted():
+    base, target = _random_bytes(1000, 4), _random_bytes(1000, 5)
+    # One byte per 127 inserted, plus the two sizes
+    assert len(delta.create_delta(base, target)) <= len(target) + len(target) // 127 + 1 + 8
+
+
+def test_copies_over_64k():
+    # Copies with offsets and sizes that need a third byte
+    base = _random_bytes(300_000, 6)
+    target = base[100_000:250_000] + b'inserted' + base[:70_000]
+    delta_ = delta.create_delta(base, target)
+    assert len(delta_) < 100
+    assert delta.apply_delta(base, delta_) == target
+
+
+def test_insert_over_max_literal():
+    target = _random_bytes(1000, 7)
+    assert delta.apply_delta(b'', delta.create_delta(b'', target)) == target
+
+
+def test_wrong_base():
+    delta_ = delta.create_delta(b'base content here', b'target')
+    with pytest.raises(AssertionError):
+        delta.apply_delta(b'another base', delta_)
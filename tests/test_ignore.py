@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+from ugit import ignore
+
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, monkeypatch):
+    # Paths are relative to the working tree, and .ugitignore files are read from it
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def _write(path, content=''):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _is_ignored(patterns, path, is_dir=False):
+    return ignore.Matcher(patterns).is_ignored(path, is_dir)
+
+
+@pytest.mark.parametrize('pattern, path, ignored', [
+    ('[ab].txt', 'a.txt', True),
+    ('[ab].txt', 'c.txt', False),
+    ('[!ab].txt', 'c.txt', True),
+    ('[^ab].txt', 'a.txt', False),
+    # A ']' right after the opening bracket, or after the negation, is a member
+    ('[]a]', ']', True),
+    ('[]a]', 'a', True),
+    ('[]a]', 'b', False),
+    ('[!]a]', 'b', True),
+    ('[!]a]', ']', False),
+    ('[!]a]', 'a', False),
+    ('[!]a]', 'ba]', False),
+    ('[!a]', '/', False),
+    ('[a-c]x', 'bx', True),
+    ('[a-c]x', 'dx', False),
+    # No closing bracket, so a literal one
+    ('[ab', '[ab', True),
+    ('[ab', 'a', False),
+])
+def test_classes(pattern, path, ignored):
+    assert _is_ignored([pattern], path) == ignored
+
+
+def test_negation():
+    patterns = ['*.log', '!keep.log']
+    assert _is_ignored(patterns, 'debug.log')
+    assert not _is_ignored(patterns, 'keep.log')
+    assert not _is_ignored(patterns, 'sub/keep.log')
+
+
+def test_last_pattern_wins():
+    assert _is_ignored(['!keep.log', '*.log'], 'keep.log')
+
+
+def test_escaped_negation():
+    assert _is_ignored(['\\!important'], '!important')
+    assert not _is_ignored(['\\!important'], 'important')
+
+
+def test_negation_inside_ignored_directory():
+    # An ignored directory is never looked into
+    patterns = ['build/', '!build/keep']
+    assert _is_ignored(patterns, 'build', is_dir=True)
+    assert _is_ignored(patterns, 'build/keep')
+
+
+def test_directory_only():
+    patterns = ['out/']
+    assert _is_ignored(patterns, 'out', is_dir=True)
+    assert _is_ignored(patterns, 'sub/out', is_dir=True)
+    assert _is_ignored(patterns, 'out/file')
+    assert not _is_ignored(patterns, 'out')
+    assert not _is_ignored(patterns, 'sub/out')
+
+
+def test_directory_only_anchored():
+    patterns = ['/out/']
+    assert _is_ignored(patterns, 'out', is_dir=True)
+    assert not _is_ignored(patterns, 'sub/out', is_dir=True)
+
+
+def test_directory_only_negated():
+    patterns = ['*', '!*/']
+    assert _is_ignored(patterns, 'file')
+    assert not _is_ignored(patterns, 'dir', is_dir=True)
+    assert _is_ignored(patterns, 'dir/file')
+
+
+def test_nested_ignore_files():
+    _write(ignore.FILENAME, '*.tmp\n')
+    _write(f'sub/{ignore.FILENAME}', '!keep.tmp\n/local\n')
+    matcher = ignore.Matcher([])
+    assert matcher.is_ignored('a.tmp', False)
+    assert matcher.is_ignored('sub/a.tmp', False)
+    assert not matcher.is_ignored('sub/keep.tmp', False)
+    assert matcher.is_ignored('sub/local', False)
+    assert not matcher.is_ignored('local', False)
+
+
+def test_walk():
+    _write(ignore.FILENAME, 'build/\n*.o\n')
+    for path in ['main.c', 'main.o', 'build/out', 'src/lib.c', 'src/lib.o', '.ugit/HEAD']:
+        _write(path)
+    found = {ignore.join(root, name) for root, _, filenames in ignore.Matcher().walk() for name in filenames}
+    assert found == {ignore.FILENAME, 'main.c', 'src/lib.c'}
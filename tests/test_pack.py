@@ -0,0 +1,97 @@
+import hashlib
+import os
+
+import pytest
+
+from ugit import delta, pack
+
+
+def _oid(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+@pytest.fixture
+def versions():
+    """Versions of a file, each adding to the previous one"""
+    content = b''
+    objects = {}
+    for version in range(6):
+        content += b''.join(b'line %d of version %d\n' % (i, version) for i in range(50))
+        objects[_oid(content)] = ('blob', content)
+    return objects
+
+
+def _write_chain(pack_dir, objects):
+    # The largest version whole, each other one a delta of the next larger. Written
+    # in oid order, so deltas come before or after their bases.
+    by_size = sorted(objects, key=lambda oid: len(objects[oid][1]))
+    bases = dict(zip(by_size, by_size[1:]))
+    with pack.PackWriter(pack_dir, len(objects)) as writer:
+        for oid in sorted(objects):
+            type_, content = objects[oid]
+            if oid in bases:
+                writer.add_delta(oid, bases[oid], delta.create_delta(objects[bases[oid]][1], content))
+            else:
+                writer.add(oid, type_, content)
+    return writer.name
+
+
+def _read_all(pack_dir, name, oids):
+    pack_ = pack.Pack(f'{pack_dir}/{name}')
+    try:
+        objects = {}
+        for oid in oids:
+            offset = pack_.find(oid)
+            assert offset is not None, oid
+            type_, size, chunks = pack_.open(offset)
+            content = b''.join(chunks)
+            assert size == len(content)
+            objects[oid] = (type_, content)
+        return objects
+    finally:
+        pack_.close()
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_write_and_read(tmp_path, versions):
+    name = pack.write_pack(str(tmp_path), sorted(versions), versions.__getitem__)
+    assert _read_all(str(tmp_path), name, versions) == versions
+
+
+def test_delta_chain_round_trip(tmp_path, versions):
+    written = str(tmp_path / 'written')
+    name = _write_chain(written, versions)
+    assert _read_all(written, name, versions) == versions
+
+    # Indexing the stream resolves the deltas to find the oids of their objects
+    received = str(tmp_path / 'received')
+    chunks = [_read_file(f'{written}/{name}.pack')]
+    assert pack.index_pack(chunks, received) == name
+    assert _read_file(f'{received}/{name}.idx') == _read_file(f'{written}/{name}.idx')
+    assert _read_all(received, name, versions) == versions
+
+
+def test_delta_pack_round_trip(tmp_path, versions):
+    written = str(tmp_path / 'written')
+    name, deltas = pack.write_delta_pack(written, sorted(versions), versions.__getitem__, [list(versions)])
+    assert deltas
+
+    received = str(tmp_path / 'received')
+    assert pack.index_pack([_read_file(f'{written}/{name}.pack')], received) == name
+    assert _read_all(received, name, versions) == versions
+
+
+def test_index_pack_missing_base(tmp_path, versions):
+    oid, (_, content) = next(iter(versions.items()))
+    written = str(tmp_path / 'written')
+    with pack.PackWriter(written, 1) as writer:
+        writer.add_delta(oid, '0' * 40, delta.create_delta(b'', content))
+
+    received = str(tmp_path / 'received')
+    with pytest.raises(AssertionError):
+        pack.index_pack([_read_file(f'{written}/{writer.name}.pack')], received)
+    assert os.listdir(received) == []
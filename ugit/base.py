@@ -1,14 +1,32 @@
 import string
 
 import ugit.types
-from . import data, diff
+from . import data, diff, cache, bitmap, pack, trace, fsmonitor, ignore
 from . import types
 
+import heapq
 import itertools
 import operator
 import os
 
-from collections import deque
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+# Worker threads for hashing files, set by UGIT_JOBS or --jobs
+JOBS = int(os.environ.get('UGIT_JOBS', 0)) or os.cpu_count() or 1
+# Fewer files than this are hashed serially, a pool isn't worth starting for them
+PARALLEL_THRESHOLD = 64
+# Commits between two bitmaps written by a full repack
+BITMAP_INTERVAL = 100
+# Unreachable loose objects younger than this are kept by gc, they may be about to be used
+GC_GRACE_PERIOD = 14 * 24 * 60 * 60
+# Commits asked about in the first round of negotiation, each round asks about twice as many
+NEGOTIATION_WINDOW = 32
+
+# Parsed commits and tree entries, shared by every walk in the process
+_commits = cache.LRUCache('commits')
+_trees = cache.LRUCache('trees')
 
 
 def init():
@@ -25,6 +43,7 @@ def get_branch_name():
     return os.path.relpath(HEAD, 'refs/heads')
 
 
+@trace.traced
 def checkout(name):
     oid = get_oid(name)
     commit_ = get_commit(oid)
@@ -48,6 +67,9 @@ def is_branch(name):
 
 
 def get_commit(oid: types.OID) -> types.Commit:
+    if cached := _commits.get(oid):
+        return cached
+
     parents = []
     tree = None
     commit_ = data.get_object(oid, 'commit').decode()
@@ -64,52 +86,68 @@ def get_commit(oid: types.OID) -> types.Commit:
 
     assert tree is not None, 'Expected tree to be defined'
     message = '\n'.join(lines)
-    return types.Commit(tree=tree, parents=parents, message=message)
+    result = types.Commit(tree=tree, parents=parents, message=message)
+    _commits.put(oid, result, size=len(commit_))
+    return result
 
 
+@trace.traced
 def write_tree():
     index_as_tree = {}
     with data.get_index() as index:
-        for path, oid in index.items():
+        for path, entry in index.items():
             path = path.split('/')
             dirpath, filename = path[:-1], path[-1]
             current = index_as_tree
             # Find the dict for the dictionary of this file
             for dirname in dirpath:
                 current = current.setdefault(dirname, {})
-            current[filename] = oid
-
-    def write_tree_recursive(tree_dict):
-        entries = []
-        for name, value in tree_dict.items():
-            if type(value) is dict:
-                type_ = 'tree'
-                oid = write_tree_recursive(value)
-            else:
-                type_ = 'blob'
-                oid = value
-            entries.append((name, oid, type_))
-
-        tree = ''.join(f'{type_} {oid} {name}\n'
-                       for name, oid, type_
-                       in sorted(entries))
-        return data.hash_object(tree.encode(), 'tree')
+            current[filename] = entry.oid
+
+        def write_tree_recursive(tree_dict, dirpath=''):
+            # Directories without changed entries since the last write keep their tree
+            cached = index.get_cached_tree(dirpath)
+            if cached:
+                trace.count('base.trees_reused')
+                return cached
+
+            entries = []
+            for name, value in tree_dict.items():
+                if type(value) is dict:
+                    type_ = 'tree'
+                    oid = write_tree_recursive(value, f'{dirpath}/{name}' if dirpath else name)
+                else:
+                    type_ = 'blob'
+                    oid = value
+                entries.append((name, oid, type_))
+
+            tree = ''.join(f'{type_} {oid} {name}\n'
+                           for name, oid, type_
+                           in sorted(entries))
+            oid = data.hash_object(tree.encode(), 'tree')
+            trace.count('base.trees_written')
+            index.set_cached_tree(dirpath, oid)
+            return oid
 
-    return write_tree_recursive(index_as_tree)
+        return write_tree_recursive(index_as_tree)
 
 
-def _iter_tree_entries(oid):
+def iter_tree_entries(oid):
     if not oid:
         return
-    tree = data.get_object(oid, 'tree')
-    for entry in tree.decode().splitlines():
-        type_, oid, name = entry.split(' ', 2)
-        yield type_, oid, name
+    entries = _trees.get(oid)
+    if entries is None:
+        tree = data.get_object(oid, 'tree')
+        entries = tuple(tuple(entry.split(' ', 2)) for entry in tree.decode().splitlines())
+        _trees.put(oid, entries, size=len(tree))
+    yield from entries
 
 
+@trace.traced
 def get_tree(oid: types.OID, base_path: types.Path = '') -> types.TreeMap:
+    trace.count('base.trees_flattened')
     result = {}
-    for type_, oid, name in _iter_tree_entries(oid):
+    for type_, oid, name in iter_tree_entries(oid):
         assert '/' not in name
         assert name not in ('..', '.')
         path = base_path + name
@@ -122,69 +160,204 @@ def get_tree(oid: types.OID, base_path: types.Path = '') -> types.TreeMap:
     return result
 
 
+@trace.traced
 def get_working_tree() -> types.TreeMap:
+    def iter_changed_files(paths):
+        for path in paths:
+            # Only files whose stat changed since they were indexed get rehashed
+            entry = index.get(path)
+            trace.count('base.files_scanned')
+            if entry and _is_unchanged(entry, os.stat(path)):
+                result[path] = entry.oid
+            else:
+                dirty.add(path)
+                yield path
+
     result = {}
-    for root, _, filenames in os.walk('.'):
-        for filename in filenames:
-            path = os.path.relpath(f'{root}/{filename}')
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            with open(path, 'rb') as f:
-                fixed_path = path.replace('\\', '/')  # window fix
-                result[fixed_path] = data.hash_object(f.read())
+    dirty = set()
+    with data.get_index(read_only=True) as index:
+        token, candidates = _get_files_to_check(index)
+        if candidates is None:
+            paths = _iter_working_files('.')
+        else:
+            # Files the fsmonitor saw no change to are as they were indexed
+            result.update((path, entry.oid) for path, entry in index.items() if path not in candidates)
+            paths = sorted(filter(os.path.isfile, candidates))
+        result.update(_hash_files(iter_changed_files(paths), write=False))
+        if token:
+            # Deleted files differ from the index too
+            fsmonitor.save(token, dirty | (index.keys() - result.keys()))
     return result
 
 
-def get_index_tree():
-    with data.get_index() as index:
-        return index
+def _iter_working_files(dirname, matcher: ignore.Matcher = None) -> Iterator[types.Path]:
+    for root, _, filenames in (matcher or ignore.Matcher()).walk(dirname):
+        for filename in filenames:
+            path = ignore.join(root, filename)
+            if os.path.isfile(path):
+                yield path
+
+
+def _get_files_to_check(index, dirname='.') -> tuple[str | None, set[types.Path] | None]:
+    """Paths under dirname that may differ from their index entry, according to the fsmonitor
+
+    Along with the fsmonitor's token. No paths when it doesn't run or can't tell, every
+    file has to be checked then.
+    """
+    monitored = fsmonitor.query()
+    if not monitored or monitored[1] is None:
+        return monitored and monitored[0], None
+    token, changed = monitored
+    matcher = ignore.Matcher()
+
+    # Changed directories are checked whole, and so are entries never compared with their file
+    directories = tuple(path for path in changed if path.endswith('/'))
+    candidates = {path for path in changed if not path.endswith('/')}
+    candidates.update(path for path, entry in index.items()
+                      if not entry.mtime_ns or directories and path.startswith(directories))
+    for directory in directories:
+        candidates.update(_iter_working_files(directory, matcher))
+
+    dirname = os.path.relpath(dirname).replace('\\', '/')
+    if dirname != '.':
+        candidates = {path for path in candidates if path.startswith(f'{dirname}/')}
+    return token, {path for path in candidates if not matcher.is_ignored(path)}
+
+
+def _hash_files(paths: Iterable[types.Path], write=True) -> Iterator[tuple[types.Path, types.OID]]:
+    # Results come back in the order of paths, whether hashed serially or in parallel
+    paths = trace.counted('base.files_hashed', paths)
+    head = list(itertools.islice(paths, PARALLEL_THRESHOLD))
+    if len(head) < PARALLEL_THRESHOLD or JOBS <= 1:
+        for path in itertools.chain(head, paths):
+            yield path, data.hash_file(path, write=write)
+        return
+
+    with ThreadPoolExecutor(JOBS) as pool:
+        # Files are submitted as the walk finds them, hashing overlaps the walk
+        futures = [(path, pool.submit(data.hash_file, path, write=write))
+                   for path in itertools.chain(head, paths)]
+        for path, future in futures:
+            yield path, future.result()
+
+
+def _index_entry(oid: types.OID, stat: os.stat_result) -> types.IndexEntry:
+    return types.IndexEntry(oid=oid, size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                            ctime_ns=stat.st_ctime_ns, ino=stat.st_ino)
+
 
+def _is_unchanged(entry: types.IndexEntry, stat: os.stat_result) -> bool:
+    return (entry.mtime_ns != 0 and
+            (entry.size, entry.mtime_ns, entry.ctime_ns, entry.ino) ==
+            (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino))
 
+
+def get_index_tree() -> types.TreeMap:
+    with data.get_index(read_only=True) as index:
+        return {path: entry.oid for path, entry in index.items()}
+
+
+@trace.traced
 def read_tree(tree_oid, update_working=False):
     with data.get_index() as index:
+        previous = dict(index.items())
         index.clear()
-        index.update(get_tree(tree_oid))
+        index.update((path, types.IndexEntry(oid)) for path, oid in get_tree(tree_oid).items())
+        _cache_subtrees(index, tree_oid)
+        # Files left out of the index now differ from it, though the working tree didn't change
+        fsmonitor.mark_dirty(previous.keys() - index.keys())
 
         if update_working:
-            _checkout_index(index)
+            _checkout_index(index, previous)
 
 
-def read_tree_merged(t_base: types.OID, t_head: types.OID, t_other: types.OID, update_working: bool = False) -> None:
+def _cache_subtrees(index, oid, dirpath=''):
+    if not oid:
+        return
+    index.set_cached_tree(dirpath, oid)
+    for type_, sub_oid, name in iter_tree_entries(oid):
+        if type_ == 'tree':
+            _cache_subtrees(index, sub_oid, f'{dirpath}/{name}' if dirpath else name)
+
+
+@trace.traced
+def read_tree_merged(t_base: types.OID, t_head: types.OID, t_other: types.OID,
+                     update_working: bool = False) -> list[types.Path]:
     with data.get_index() as index:
+        previous = dict(index.items())
         index.clear()
-        merged_tree = diff.merge_trees(
-            get_tree(t_base),
-            get_tree(t_head),
-            get_tree(t_other)
-        )
-        index.update(merged_tree)
+        merged_tree, conflicts = diff.merge_trees(t_base, t_head, t_other)
+        index.update((path, types.IndexEntry(oid)) for path, oid in merged_tree.items())
+        fsmonitor.mark_dirty(previous.keys() - index.keys())
         if update_working:
-            _checkout_index(index)
+            _checkout_index(index, previous)
+    return conflicts
 
 
-def _checkout_index(index):
-    _empty_current_directory()
-    for path, oid in index.items():
-        os.makedirs(os.path.dirname(f'./{path}'), exist_ok=True)
-        with open(path, 'wb') as f:
-            f.write(data.get_object(oid, 'blob'))
+@trace.traced
+def _checkout_index(index, previous: dict[types.Path, types.IndexEntry]):
+    # Only paths that differ from the previous index are touched in the working tree
+    removed = [path for path in previous if path not in index]
+    changed = [path for path, entry in index.items()
+               if path not in previous or previous[path].oid != entry.oid]
 
+    # Check every path first, so a refused checkout leaves the working tree as it was
+    for path in removed + changed:
+        if _has_local_changes(path, previous.get(path), index.get(path)):
+            raise AssertionError(f'Local changes to {path} would be overwritten by checkout')
 
-def _empty_current_directory():
-    for root, dirnames, filenames in os.walk('.', topdown=False):
-        for filename in filenames:
-            path = os.path.relpath(f'{root}/{filename}')
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
+    for path in removed:
+        if os.path.isfile(path):
             os.remove(path)
-        for dirname in dirnames:
-            path = os.path.relpath(f'{root}/{dirname}')
-            if is_ignored(path):
-                continue
-            try:
-                os.rmdir(path)
-            except (FileNotFoundError, OSError):
-                pass  # ignored file in dir
+        _remove_empty_parents(path)
+
+    # A partial clone gets all the blobs it lacks in one request, not one per file
+    data.prefetch_objects(index[path].oid for path in changed)
+    for path, stat in _write_files([(path, index[path].oid) for path in changed]):
+        index[path] = _index_entry(index[path].oid, stat)
+
+    # Untouched files keep their stat data, so they aren't rehashed later
+    for path in index.keys() & previous.keys() - set(changed):
+        index[path] = previous[path]
+
+
+def _has_local_changes(path, old_entry: types.IndexEntry | None, new_entry: types.IndexEntry | None) -> bool:
+    if not os.path.isfile(path):
+        return False
+    if old_entry and _is_unchanged(old_entry, os.stat(path)):
+        return False
+    oid = data.hash_file(path, write=False)
+    return oid not in (old_entry and old_entry.oid, new_entry and new_entry.oid)
+
+
+def _remove_empty_parents(path):
+    parent = os.path.dirname(path)
+    while parent:
+        try:
+            os.rmdir(parent)
+        except OSError:
+            return  # not empty, or holds ignored files
+        parent = os.path.dirname(parent)
+
+
+def _write_files(files: list[tuple[types.Path, types.OID]]) -> Iterator[tuple[types.Path, os.stat_result]]:
+    if len(files) < PARALLEL_THRESHOLD or JOBS <= 1:
+        for path, oid in files:
+            yield path, _write_file(path, oid)
+        return
+
+    with ThreadPoolExecutor(JOBS) as pool:
+        paths = [path for path, _ in files]
+        yield from zip(paths, pool.map(_write_file, paths, [oid for _, oid in files]))
+
+
+def _write_file(path: types.Path, oid: types.OID) -> os.stat_result:
+    trace.count('base.files_written')
+    os.makedirs(os.path.dirname(f'./{path}'), exist_ok=True)
+    with open(path, 'wb') as f:
+        for chunk in data.iter_object(oid, 'blob'):
+            f.write(chunk)
+    return os.stat(path)
 
 
 def reset(oid):
@@ -199,20 +372,101 @@ def create_tag(name, oid):
     data.update_ref(f'refs/tags/{name}', ugit.types.RefValue(symbolic=False, value=oid))
 
 
+@trace.traced
 def get_merge_base(oid1: types.OID, oid2: types.OID) -> types.OID:
-    parents1 = set(iter_commits_and_parents({oid1}))
-
-    for oid in iter_commits_and_parents({oid2}):
-        if oid in parents1:
+    # Walk both histories highest generation first. Descendants always have a higher
+    # generation, so the first commit seen from both sides is the nearest common one.
+    generations = {}
+    reached_from = {oid1: 1}
+    # Both sides may start from the same commit
+    reached_from[oid2] = reached_from.get(oid2, 0) | 2
+    queue = [(-_get_generation(oid, generations), oid) for oid in {oid1, oid2}]
+    heapq.heapify(queue)
+    while queue:
+        _, oid = heapq.heappop(queue)
+        if reached_from[oid] == 3:
             return oid
+        for parent in _get_parents(oid):
+            reached = reached_from.get(parent, 0) | reached_from[oid]
+            if reached != reached_from.get(parent):
+                reached_from[parent] = reached
+                heapq.heappush(queue, (-_get_generation(parent, generations), parent))
 
     assert False, "A merge base must exist"
 
 
 def is_ancestor_of(commit_, maybe_ancestor):
-    return maybe_ancestor in iter_commits_and_parents({commit_})
+    if not data.object_exists(maybe_ancestor):
+        return False
+    # Commits with a generation at or below the ancestor's can't lead to it
+    generations = {}
+    min_generation = _get_generation(maybe_ancestor, generations)
+    oids = [commit_]
+    visited = set()
+    while oids:
+        oid = oids.pop()
+        if oid == maybe_ancestor:
+            return True
+        if oid in visited:
+            continue
+        visited.add(oid)
+        oids.extend(parent for parent in _get_parents(oid)
+                    if parent == maybe_ancestor or _get_generation(parent, generations) > min_generation)
+    return False
+
+
+def _get_parents(oid: types.OID) -> list[types.OID]:
+    # The history of a shallow clone ends at its boundary commits
+    if oid in data.get_shallow():
+        return []
+    graph = data.get_commit_graph()
+    position = graph.find(oid) if graph else None
+    if position is None:
+        return get_commit(oid).parents
+    return [graph.oid(parent) for parent in graph.parents(position)]
+
+
+def _get_generation(oid: types.OID, generations: dict[types.OID, int]) -> int:
+    # Read from the commit graph, computed only for commits made since it was written
+    graph = data.get_commit_graph()
+    oids = [oid]
+    while oids:
+        current = oids[-1]
+        if current in generations:
+            oids.pop()
+            continue
+        position = graph.find(current) if graph else None
+        if position is not None:
+            generations[current] = graph.generation(position)
+            continue
+        parents = _get_parents(current)
+        missing = [parent for parent in parents if parent not in generations]
+        if missing:
+            oids.extend(missing)
+            continue
+        generations[current] = 1 + max((generations[parent] for parent in parents), default=0)
+    return generations[oid]
+
 
+@trace.traced
+def update_commit_graph(oids: Iterable[types.OID]):
+    # Only the commits missing from the graph are added, as a layer on top of it
+    graph = data.get_commit_graph()
+    new_commits = {}
+    oids = list(oids)
+    while oids:
+        oid = oids.pop()
+        if not oid or oid in new_commits or (graph and graph.find(oid) is not None):
+            continue
+        parents = _get_parents(oid)
+        new_commits[oid] = (get_commit(oid).tree, parents)
+        oids.extend(parents)
 
+    if new_commits:
+        data.add_to_commit_graph(new_commits)
+
+
+@trace.traced
 def merge(other):
     HEAD = data.get_ref('HEAD').value
     assert HEAD
@@ -226,14 +480,16 @@ def merge(other):
         print('Fast-forward merge, no need to commit')
         return
 
-    data.update_ref('MERGE_HEAD', data.RefValue(symbolic=False, value=other))
-
     c_base = get_commit(merge_base)
     c_HEAD = get_commit(HEAD)
-    read_tree_merged(c_base.tree, c_HEAD.tree, c_other.tree, update_working=True)
+    conflicts = read_tree_merged(c_base.tree, c_HEAD.tree, c_other.tree, update_working=True)
+    data.update_ref('MERGE_HEAD', data.RefValue(symbolic=False, value=other))
+    for path in conflicts:
+        print(f'CONFLICT (content): Merge conflict in {path}')
     print('Merged in working tree\nPlease commit')
 
 
+@trace.traced
 def commit(message):
     commit_ = f'tree {write_tree()}\n'
 
@@ -251,6 +507,7 @@ def commit(message):
 
     oid = data.hash_object(commit_.encode(), 'commit')
     data.update_ref("HEAD", ugit.types.RefValue(symbolic=False, value=oid))
+    update_commit_graph([oid])
     return oid
 
 
@@ -284,65 +541,364 @@ def iter_commits_and_parents(oids):
         if not oid or oid in visited:
             continue
         visited.add(oid)
+        trace.count('base.commits_walked')
         yield oid
 
-        commit_ = get_commit(oid)
-        oids.extendleft(commit_.parents[:1])
-        oids.extend(commit_.parents[1:])
+        parents = _get_parents(oid)
+        oids.extendleft(parents[:1])
+        oids.extend(parents[1:])
 
 
 def iter_objects_in_commits(oids):
     visited = set()
+    for oid in iter_commits_and_parents(oids):
+        yield oid
+        yield from _iter_objects_in_tree(get_commit(oid).tree, visited)
 
-    def iter_objects_in_tree(source_tree_oid):
-        visited.add(source_tree_oid)
-        yield source_tree_oid
-        for type_, oid_, _ in _iter_tree_entries(source_tree_oid):
-            if oid_ not in visited:
+
+def _iter_objects_in_tree(tree_oid, visited, blobs=True):
+    if tree_oid in visited:
+        return
+    visited.add(tree_oid)
+    yield tree_oid
+    for type_, oid, _ in iter_tree_entries(tree_oid):
+        if oid not in visited:
+            if type_ == 'tree':
+                yield from _iter_objects_in_tree(oid, visited, blobs)
+            elif blobs:
+                visited.add(oid)
+                yield oid
+
+
+@trace.traced
+def find_common_commits(tips: Iterable[types.OID],
+                        has_commits: Callable[[list[types.OID]], set[types.OID]],
+                        known: Iterable[types.OID] = ()) -> set[types.OID]:
+    # Walk back from the tips asking the other side which commits it has, a growing
+    # window of them per round trip. The ancestors of a commit it has are common too,
+    # so the walk stops there and only covers the commits made since both sides
+    # diverged. Known commits, like its tips that are here too, are common without
+    # asking. Highest generation first, so a commit is only asked about once all
+    # the known commits above it have been seen.
+    generations = {}
+    common = set(filter(None, known))
+    reached = set(common)
+    visited = set()
+    queue = []
+
+    def visit(oid):
+        if oid not in visited:
+            visited.add(oid)
+            heapq.heappush(queue, (-_get_generation(oid, generations), oid))
+
+    for oid in itertools.chain(common, filter(None, tips)):
+        visit(oid)
+    window = NEGOTIATION_WINDOW
+    # Stop once only common commits are left to walk
+    while not all(oid in reached for _, oid in queue):
+        batch = []
+        while queue and len(batch) < window:
+            _, oid = heapq.heappop(queue)
+            if oid in reached:
+                reached.update(_get_parents(oid))
+            else:
+                batch.append(oid)
+            for parent in _get_parents(oid):
+                visit(parent)
+        if batch:
+            found = has_commits(batch)
+            common.update(found)
+            _mark_reached(found, reached, visited)
+            window *= 2
+    return common
+
+
+def _mark_reached(oids, reached, visited):
+    # The window walks ahead, commits visited below one found common are common too
+    oids = list(oids)
+    while oids:
+        oid = oids.pop()
+        if oid not in reached:
+            reached.add(oid)
+            oids.extend(parent for parent in _get_parents(oid) if parent in visited)
+
+
+def iter_objects_to_send(wants: Iterable[types.OID], common: Iterable[types.OID],
+                         depth: int | None = None, blobs=True,
+                         shallow: Iterable[types.OID] = ()) -> Iterator[types.OID]:
+    """Objects reachable from wants but not from the common commits, which the receiver has
+
+    With a depth, only the commits up to that many generations from the wants are sent,
+    and without blobs only commits and trees. The receiver's history ends at its
+    shallow commits, what lies beyond them is sent too.
+    """
+    shallow = set(shallow)
+    if depth or shallow:
+        return _iter_shallow_objects_to_send(wants, common, depth, blobs, shallow)
+    pack_ = data.get_bitmapped_pack()
+    if pack_ and blobs:
+        return _iter_objects_to_send_with_bitmap(wants, common, pack_)
+    return _iter_objects_to_send_by_walk(wants, common, blobs)
+
+
+def get_shallow_boundary(wants: Iterable[types.OID], common: Iterable[types.OID], depth: int,
+                         shallow: Iterable[types.OID] = ()) -> set[types.OID]:
+    """Commits sent for a depth whose parents aren't, the receiver's new shallow commits"""
+    return _get_commits_within_depth(wants, common, depth, set(shallow))[1]
+
+
+def _iter_shallow_objects_to_send(wants, common, depth, blobs, shallow) -> Iterator[types.OID]:
+    # Only commits close to the wants are walked, objects in the trees of the
+    # commits the receiver has are assumed to be with it
+    common = set(common)
+    commits = _get_commits_within_depth(wants, common, depth, shallow)[0]
+    had = _get_commits_had(common, shallow, commits)
+    visited = set()
+    for oid in common | had:
+        visited.update(_iter_objects_in_tree(get_commit(oid).tree, visited))
+    for oid in commits:
+        if oid not in had:
+            yield oid
+            yield from _iter_objects_in_tree(get_commit(oid).tree, visited, blobs)
+
+
+def _get_commits_within_depth(wants, common, depth, shallow) -> tuple[list[types.OID], set[types.OID]]:
+    # All of them without a depth. Below a commit of a shallow receiver may be
+    # history it lacks, so the walk only stops at common commits of a complete one.
+    commits = []
+    boundary = set()
+    visited = set() if shallow else set(common)
+    level = [oid for oid in dict.fromkeys(wants) if oid and oid not in visited]
+    distance = 0
+    while level:
+        distance += 1
+        visited.update(level)
+        commits.extend(level)
+        if distance == depth:
+            boundary = {oid for oid in level if _get_parents(oid)}
+            break
+        level = list(dict.fromkeys(parent for oid in level for parent in _get_parents(oid)
+                                   if parent not in visited))
+    return commits, boundary
+
+
+def _get_commits_had(common, shallow, commits) -> set[types.OID]:
+    """Which of commits the receiver has: those reachable from its common commits down to its shallow ones"""
+    commits = set(commits)
+    generations = {}
+    # Ancestors have a lower generation, those below every commit asked about can be left out
+    lowest = min((_get_generation(oid, generations) for oid in commits), default=0)
+    reached = set()
+    oids = list(common)
+    while oids:
+        oid = oids.pop()
+        if oid in reached or _get_generation(oid, generations) < lowest:
+            continue
+        reached.add(oid)
+        if oid not in shallow:
+            oids.extend(_get_parents(oid))
+    return reached & commits
+
+
+def _iter_objects_to_send_with_bitmap(wants, common, pack_) -> Iterator[types.OID]:
+    # Reachability within the pack comes from the nearest bitmaps, only commits
+    # made since the pack was written are walked
+    wanted, wanted_outside = _reachable_in_pack(wants, pack_.index, pack_.bitmap.get)
+    had, had_outside = _reachable_in_pack(common, pack_.index, pack_.bitmap.get)
+    missing = int.from_bytes(wanted, 'little') & ~int.from_bytes(had, 'little')
+    for position in bitmap.iter_positions(missing):
+        yield pack_.index.oid(position)
+    yield from wanted_outside - had_outside
+
+
+def _reachable_in_pack(tips: Iterable[types.OID], index: pack.PackIndex,
+                       get_bitmap: Callable[[types.OID], int | None]) -> tuple[bytearray, set[types.OID]]:
+    """Objects reachable from tips, as a bitset over the pack index and a set of those outside of it"""
+    bits = bytearray((len(index) + 7) // 8)
+    outside = set()
+
+    # Marking an object marks everything reachable from it before returning, so
+    # anything found marked is skipped together with its whole history or subtree
+    def mark(oid) -> bool:
+        position = index.position(oid)
+        if position is None:
+            if oid in outside:
+                return False
+            outside.add(oid)
+            return True
+        byte, bit = position >> 3, 1 << (position & 7)
+        if bits[byte] & bit:
+            return False
+        bits[byte] |= bit
+        return True
+
+    def mark_tree(tree_oid):
+        if mark(tree_oid):
+            for type_, oid, _ in iter_tree_entries(tree_oid):
                 if type_ == 'tree':
-                    yield from iter_objects_in_tree(oid_)
+                    mark_tree(oid)
                 else:
-                    visited.add(oid_)
-                    yield oid_
+                    mark(oid)
+
+    commits = [oid for oid in tips if oid]
+    while commits:
+        oid = commits.pop()
+        stored = get_bitmap(oid)
+        if stored is not None:
+            bits[:] = (int.from_bytes(bits, 'little') | stored).to_bytes(len(bits), 'little')
+        elif mark(oid):
+            mark_tree(get_commit(oid).tree)
+            commits.extend(_get_parents(oid))
+    return bits, outside
+
+
+@trace.traced
+def write_bitmaps(pack_name):
+    """Write bitmaps for the ref tips and every BITMAP_INTERVAL commits of a pack holding all their objects"""
+    # A partial clone's pack lacks the objects it never fetched, which bitmaps need
+    if data.get_promisor():
+        return 0
+    pack_ = data.get_pack(pack_name)
+    generations = {}
+    tips = {ref.value for _, ref in data.iter_refs()}
+    commits = sorted(iter_commits_and_parents(tips), key=lambda oid: _get_generation(oid, generations))
+    assert all(pack_.index.position(oid) is not None for oid in commits), f'{pack_name} lacks commits'
+
+    # Parents come first, so each bitmap builds on those of the commits below it
+    bitmaps = {}
+    for i, oid in enumerate(commits):
+        if oid in tips or i % BITMAP_INTERVAL == 0:
+            bits, outside = _reachable_in_pack([oid], pack_.index, bitmaps.get)
+            assert not outside, f'{pack_name} lacks objects reachable from {oid}'
+            bitmaps[oid] = int.from_bytes(bits, 'little')
+    pack_.write_bitmap(bitmaps)
+    return len(bitmaps)
+
+
+@trace.traced
+def gc(grace_period=GC_GRACE_PERIOD) -> dict[str, int]:
+    """Pack every object with deltas between versions of a path and prune unreachable loose objects"""
+    size_before = data.get_storage_size()
+    paths = _get_reachable_paths()
+    # Packed objects are kept even when unreachable, they may be a push whose ref isn't updated yet
+    to_pack = sorted(oid for oid in paths.keys() | set(data.iter_packed_objects()) if data.object_exists(oid))
+
+    groups = defaultdict(list)
+    for oid in to_pack:
+        if paths.get(oid) is not None:
+            groups[paths[oid]].append(oid)
+    name, deltas = data.write_delta_pack(to_pack, groups.values()) if to_pack else (None, 0)
+    data.remove_packs(keep=name)
+    pruned = data.prune_loose_objects(grace_period)
+    update_commit_graph(ref.value for _, ref in data.iter_refs())
+    if name:
+        write_bitmaps(name)
+
+    return {'objects': len(to_pack), 'deltas': deltas, 'pruned': pruned,
+            'size_before': size_before, 'size_after': data.get_storage_size()}
+
+
+def _get_reachable_paths() -> dict[types.OID, types.Path | None]:
+    """Objects reachable from refs or the index, trees and blobs with the first path they were seen at"""
+    paths = {}
+
+    def walk_tree(tree_oid, tree_path):
+        if tree_oid in paths:
+            return
+        paths[tree_oid] = tree_path
+        for type_, oid, name in iter_tree_entries(tree_oid):
+            path = f'{tree_path}/{name}' if tree_path else name
+            if type_ == 'tree':
+                walk_tree(oid, path)
+            else:
+                paths.setdefault(oid, path)
+
+    for oid in iter_commits_and_parents(ref.value for _, ref in data.iter_refs()):
+        paths[oid] = None
+        walk_tree(get_commit(oid).tree, '')
+
+    # Staged files and the trees cached for the next commit aren't in any commit yet
+    with data.get_index(read_only=True) as index:
+        for path, entry in index.items():
+            paths.setdefault(entry.oid, path)
+        for dirpath, oid in index.cached_trees().items():
+            walk_tree(oid, dirpath)
+    return paths
+
+
+def _iter_objects_to_send_by_walk(wants, common, blobs=True) -> Iterator[types.OID]:
+    # Walk highest generation first, so a commit is only reached after all its
+    # descendants and knows whether it's reachable from a common commit
+    generations = {}
+    uninteresting = {}
+    queue = []
+    pending = 0  # Queued commits that may have to be sent
+
+    def push(oid, is_uninteresting):
+        nonlocal pending
+        if oid in uninteresting:
+            if is_uninteresting and not uninteresting[oid]:
+                uninteresting[oid] = True
+                pending -= 1
+            return
+        uninteresting[oid] = is_uninteresting
+        pending += not is_uninteresting
+        heapq.heappush(queue, (-_get_generation(oid, generations), oid))
+
+    for oid in common:
+        push(oid, True)
+    for oid in wants:
+        if oid:
+            push(oid, False)
+
+    to_send = []
+    while pending:
+        _, oid = heapq.heappop(queue)
+        if not uninteresting[oid]:
+            pending -= 1
+            to_send.append(oid)
+        for parent in _get_parents(oid):
+            push(parent, uninteresting[oid])
+
+    # The receiver has everything in the trees of the commits the sent ones build on
+    visited = set()
+    boundary = {parent for oid in to_send for parent in _get_parents(oid) if uninteresting[parent]}
+    for oid in boundary:
+        visited.update(_iter_objects_in_tree(get_commit(oid).tree, visited))
 
-    for oid in iter_commits_and_parents(oids):
+    for oid in to_send:
         yield oid
-        commit_ = get_commit(oid)
-        if commit_.tree not in visited:
-            yield from iter_objects_in_tree(commit_.tree)
+        yield from _iter_objects_in_tree(get_commit(oid).tree, visited, blobs)
 
 
+@trace.traced
 def add(filenames):
     def add_file(filename):
         # Normalize path
         filename = os.path.relpath(filename).replace('\\', '/')
-        with open(filename, 'rb') as f:
-            oid = data.hash_object(f.read())
-        index[filename] = oid
+        # Stat before hashing, so a write during hashing shows up as a stat change
+        stats[filename] = os.stat(filename)
+        entry = index.get(filename)
+        if not (entry and _is_unchanged(entry, stats[filename])):
+            yield filename
 
     def add_directory(dirname):
-        for root, _, filenames_inner in os.walk(dirname):
-            for filename_inner in filenames_inner:
-                path = os.path.relpath(f'{root}/{filename_inner}').replace('\\', '/')
-                if is_ignored(path) or not os.path.isfile(path):
-                    continue
-                add_file(path)
+        _, candidates = _get_files_to_check(index, dirname)
+        if candidates is None:
+            paths = _iter_working_files(dirname)
+        else:
+            paths = sorted(filter(os.path.isfile, candidates))
+        for path in paths:
+            yield from add_file(path)
 
-    with data.get_index() as index:
+    def iter_files_to_hash():
         for name in filenames:
             if os.path.isfile(name):
-                add_file(name)
+                yield from add_file(name)
             elif os.path.isdir(name):
-                add_directory(name)
-
-
-def is_ignored(path):
-    path = path.replace('\\', '/')
-    return (
-            ('.ugit' in path.split('/')) or
-            ('venv' in path.split('/')) or
-            ('ugit.egg-info' in path.split('/')) or
-            ('__pycache__' in path.split('/')) or
-            ('.idea' in path.split('/')) or
-            ('.git' in path.split('/'))
-    )
+                yield from add_directory(name)
+
+    stats = {}
+    with data.get_index() as index:
+        for filename, oid in _hash_files(iter_files_to_hash()):
+            index[filename] = _index_entry(oid, stats[filename])
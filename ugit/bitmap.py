@@ -0,0 +1,66 @@
+import hashlib
+import mmap
+import struct
+import zlib
+
+from . import types, files
+
+SIGNATURE = b'UBMP'
+VERSION = 1
+
+# Layout: header, then per selected commit its binary oid, the length of its
+# bitmap and the bitmap, sha1 of everything before it. Bit i of a bitmap is set
+# when the i-th object of the pack index, in oid order, is reachable from the
+# commit. Bitmaps are little endian integers compressed with zlib.
+_HEADER = struct.Struct('>4sI20sI')
+_ENTRY = struct.Struct('>20sI')
+_CHECKSUM_SIZE = 20
+
+
+class BitmapIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as raw:
+            signature, version, self.pack_checksum, count = _HEADER.unpack_from(raw)
+            assert signature == SIGNATURE, f'{path} is not a bitmap index'
+            assert version == VERSION, f'Unsupported bitmap version {version}'
+            # Bitmaps are only inflated when asked for
+            self._bitmaps: dict[types.OID, bytes | int] = {}
+            offset = _HEADER.size
+            for _ in range(count):
+                oid, length = _ENTRY.unpack_from(raw, offset)
+                offset += _ENTRY.size
+                self._bitmaps[oid.hex()] = raw[offset:offset + length]
+                offset += length
+
+    def __contains__(self, oid: types.OID):
+        return oid in self._bitmaps
+
+    def __len__(self):
+        return len(self._bitmaps)
+
+    def get(self, oid: types.OID) -> int | None:
+        bitmap = self._bitmaps.get(oid)
+        if isinstance(bitmap, bytes):
+            bitmap = self._bitmaps[oid] = int.from_bytes(zlib.decompress(bitmap), 'little')
+        return bitmap
+
+
+def write_bitmaps(path, pack_checksum: bytes, bitmaps: dict[types.OID, int]):
+    parts = [_HEADER.pack(SIGNATURE, VERSION, pack_checksum, len(bitmaps))]
+    for oid in sorted(bitmaps):
+        bitmap = bitmaps[oid]
+        compressed = zlib.compress(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little'))
+        parts.append(_ENTRY.pack(bytes.fromhex(oid), len(compressed)) + compressed)
+    body = b''.join(parts)
+
+    with files.write_atomic(path, read_only=True) as f:
+        f.write(body + hashlib.sha1(body).digest())
+
+
+def iter_positions(bitmap: int):
+    # Scanning the binary string runs in C, unlike shifting a huge int bit by bit
+    digits = bin(bitmap)[:1:-1]
+    position = digits.find('1')
+    while position != -1:
+        yield position
+        position = digits.find('1', position + 1)
@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
+
+# Budget of each cache, objects are immutable so entries never go stale
+MAX_ENTRIES = int(os.environ.get('UGIT_CACHE_ENTRIES', 100_000))
+MAX_BYTES = int(os.environ.get('UGIT_CACHE_BYTES', 64 * 1024 * 1024))
+
+_caches: list['LRUCache'] = []
+
+
+class LRUCache:
+    def __init__(self, name, max_entries=None, max_bytes=None):
+        self.name = name
+        self.max_entries = MAX_ENTRIES if max_entries is None else max_entries
+        self.max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._bytes = 0
+        # Checkout reads objects from several threads
+        self._lock = threading.Lock()
+        _caches.append(self)
+
+    def get(self, key):
+        with self._lock:
+            found = self._entries.get(key)
+            if found is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return found[0]
+
+    def put(self, key, value, size=1):
+        if size > self.max_bytes or not self.max_entries:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self) -> dict[str, int | str]:
+        return {'name': self.name, 'entries': len(self._entries), 'bytes': self._bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def stats() -> list[dict[str, int | str]]:
+    return [cache.stats() for cache in _caches]
+
+
+def print_stats(file=sys.stderr):
+    for stat in stats():
+        lookups = stat['hits'] + stat['misses']
+        hit_rate = stat['hits'] / lookups if lookups else 0
+        print(f'cache {stat["name"]}: {stat["hits"]} hits, {stat["misses"]} misses ({hit_rate:.0%}), '
+              f'{stat["evictions"]} evictions, {stat["entries"]} entries, {stat["bytes"]} bytes', file=file)
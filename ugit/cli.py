@@ -1,22 +1,53 @@
 import argparse
+import contextlib
+import itertools
 import os
+import socket
 import subprocess
 import sys
 import textwrap
 
 import ugit.types
-from . import data, diff, remote
+from . import data, diff, remote, cache, server, transport, trace, fsmonitor
 from . import base
 
+# Output of log, show and diff goes through the pager when stdout is a terminal
+USE_PAGER = True
+
 
 def main():
     with data.change_git_dir('.'):
         args = parse_args()
-        args.func(args)
+        if getattr(args, 'jobs', None):
+            base.JOBS = args.jobs
+        if getattr(args, 'external_diff', False):
+            diff.USE_EXTERNAL_DIFF = True
+        if args.trace or args.trace_file:
+            trace.enable(args.trace_file or '1')
+        if args.no_pager:
+            global USE_PAGER
+            USE_PAGER = False
+        try:
+            with trace.span(f'cli.{args.command}'):
+                args.func(args)
+        except BrokenPipeError:
+            # The reader, like head, went away: stop quietly, without the flush at exit failing again
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
+        finally:
+            trace.report()
+    if os.environ.get('UGIT_CACHE_STATS'):
+        cache.print_stats()
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
+    parser.add_argument('--trace', action='store_true',
+                        help='print where the time went once done (default: UGIT_TRACE=1)')
+    parser.add_argument('--trace-file', metavar='FILE',
+                        help='write a Chrome trace with the timings and counters to FILE (default: UGIT_TRACE=FILE)')
+    parser.add_argument('--no-pager', action='store_true',
+                        help='write to stdout even on a terminal (default pager: UGIT_PAGER, PAGER or less)')
     commands = parser.add_subparsers(dest='command')
     commands.required = True
 
@@ -27,11 +58,21 @@ def parse_args():
 
     hash_object_parser = commands.add_parser('hash-object')
     hash_object_parser.set_defaults(func=hash_object)
-    hash_object_parser.add_argument('file')
+    hash_object_parser.add_argument('file', nargs='?')
+    hash_object_parser.add_argument('--stdin-paths', action='store_true',
+                                    help='hash the files named on each line of stdin')
+    hash_object_parser.add_argument('-w', dest='write', action='store_true',
+                                    help='store the objects of --stdin-paths, a single file is always stored')
 
     cat_file_parser = commands.add_parser('cat-file')
     cat_file_parser.set_defaults(func=cat_file)
-    cat_file_parser.add_argument('object', type=oid)
+    cat_file_parser.add_argument('object', type=oid, nargs='?')
+    batch_group = cat_file_parser.add_mutually_exclusive_group()
+    batch_group.add_argument('--batch', action='store_true',
+                             help="print '<oid> <type> <size>' and the content of the objects named on each line "
+                                  "of stdin, '<name> missing' for unknown ones")
+    batch_group.add_argument('--batch-check', action='store_true',
+                             help='like --batch without the content')
 
     write_tree_parser = commands.add_parser('write-tree')
     write_tree_parser.set_defaults(func=write_tree)
@@ -47,15 +88,21 @@ def parse_args():
     log_parser = commands.add_parser('log')
     log_parser.set_defaults(func=log)
     log_parser.add_argument('oid', default='@', type=oid, nargs='?')
+    log_parser.add_argument('-n', '--max-count', type=int, help='show at most this many commits')
+    log_parser.add_argument('--skip', type=int, default=0, help='skip this many commits first')
+    log_parser.add_argument('--oneline', action='store_true', help='one line per commit: its oid and subject')
 
     show_parser = commands.add_parser('show')
     show_parser.set_defaults(func=show)
     show_parser.add_argument('oid', default='@', type=oid, nargs='?')
+    show_parser.add_argument('--external-diff', action='store_true', help='use the system diff tool')
 
     diff_parser = commands.add_parser('diff')
     diff_parser.set_defaults(func=diff_func)
     diff_parser.add_argument('--cached', action='store_true')
     diff_parser.add_argument('commit', nargs='?')
+    diff_parser.add_argument('-j', '--jobs', type=int)
+    diff_parser.add_argument('--external-diff', action='store_true', help='use the system diff tool')
 
     checkout_parser = commands.add_parser('checkout')
     checkout_parser.set_defaults(func=checkout)
@@ -76,6 +123,7 @@ def parse_args():
 
     status_parser = commands.add_parser('status')
     status_parser.set_defaults(func=status)
+    status_parser.add_argument('-j', '--jobs', type=int)
 
     reset_parser = commands.add_parser('reset')
     reset_parser.set_defaults(func=reset)
@@ -93,15 +141,58 @@ def parse_args():
     fetch_parser = commands.add_parser('fetch')
     fetch_parser.set_defaults(func=fetch)
     fetch_parser.add_argument('remote')
+    fetch_parser.add_argument('--depth', type=int, help='only fetch this many commits of history')
+    fetch_parser.add_argument('--filter', choices=['blob:none'],
+                              help='leave out blobs, they are fetched from the remote when needed')
+    fetch_parser.add_argument('-j', '--jobs', type=int,
+                              help='number of objects packed in parallel (default: UGIT_JOBS or CPU count)')
 
     push_parser = commands.add_parser('push')
     push_parser.set_defaults(func=push)
     push_parser.add_argument('remote')
     push_parser.add_argument('branch')
+    push_parser.add_argument('-j', '--jobs', type=int,
+                             help='number of objects packed in parallel (default: UGIT_JOBS or CPU count)')
+
+    serve_parser = commands.add_parser('serve', help='serve this repository to ugit:// remotes')
+    serve_parser.set_defaults(func=serve)
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=transport.DEFAULT_PORT)
+    serve_parser.add_argument('--socket', help='listen on a Unix socket at this path instead')
+    serve_parser.add_argument('-j', '--jobs', type=int,
+                              help='number of objects packed in parallel (default: UGIT_JOBS or CPU count)')
 
     add_parser = commands.add_parser('add')
     add_parser.set_defaults(func=add)
     add_parser.add_argument('files', nargs='+')
+    add_parser.add_argument('-j', '--jobs', type=int,
+                            help='number of files hashed in parallel (default: UGIT_JOBS or CPU count)')
+
+    fsmonitor_parser = commands.add_parser('fsmonitor',
+                                           help='watch the working tree, so status, diff and add skip the full scan')
+    fsmonitor_parser.set_defaults(func=fsmonitor_func)
+    fsmonitor_parser.add_argument('action', choices=['start', 'stop', 'status', 'run'],
+                                  help='run is start without going to the background')
+    fsmonitor_parser.add_argument('--poll', action='store_true', help='rescan on every query instead of using inotify')
+
+    commit_graph_parser = commands.add_parser('commit-graph')
+    commit_graph_parser.set_defaults(func=commit_graph)
+
+    pack_refs_parser = commands.add_parser('pack-refs')
+    pack_refs_parser.set_defaults(func=pack_refs)
+
+    gc_parser = commands.add_parser('gc')
+    gc_parser.set_defaults(func=gc)
+    gc_parser.add_argument('--grace-period', type=int, default=base.GC_GRACE_PERIOD,
+                           help='seconds unreachable loose objects are kept for (default: two weeks)')
+
+    repack_parser = commands.add_parser('repack')
+    repack_parser.set_defaults(func=repack)
+    repack_parser.add_argument('-d', dest='delete_loose', action='store_true',
+                               help='delete loose objects once they are packed')
+    repack_parser.add_argument('-a', dest='all', action='store_true',
+                               help='pack every object into a single pack with reachability bitmaps, '
+                                    'with -d also delete the old packs')
 
     return parser.parse_args()
 
@@ -112,13 +203,39 @@ def init(_):
 
 
 def hash_object(args):
-    with open(args.file, 'rb') as f:
-        print(data.hash_object(f.read()))
+    assert bool(args.file) != args.stdin_paths, 'Give either a file or --stdin-paths'
+    if args.file:
+        print(data.hash_file(args.file))
+        return
+    # One process for a whole pipeline: every answer is flushed before the next line is read
+    for line in sys.stdin:
+        print(data.hash_file(line.rstrip('\n'), write=args.write), flush=True)
 
 
 def cat_file(args):
+    batch = args.batch or args.batch_check
+    assert bool(args.object) != batch, 'Give either an object or --batch/--batch-check'
     sys.stdout.flush()
-    sys.stdout.buffer.write(data.get_object(args.object, expected=None))
+    if not batch:
+        for chunk in data.iter_object(args.object, expected=None):
+            sys.stdout.buffer.write(chunk)
+        return
+
+    out = sys.stdout.buffer
+    for line in sys.stdin.buffer:
+        name = line.rstrip(b'\n').decode()
+        try:
+            oid = base.get_oid(name)
+            type_, size, chunks = data.open_object(oid)
+        except (AssertionError, FileNotFoundError):
+            out.write(f'{name} missing\n'.encode())
+        else:
+            out.write(f'{oid} {type_} {size}\n'.encode())
+            if args.batch:
+                for chunk in chunks:
+                    out.write(chunk)
+                out.write(b'\n')
+        out.flush()
 
 
 def write_tree(args):
@@ -138,16 +255,42 @@ def log(args):
     for refname, ref in data.iter_refs():
         refs.setdefault(ref.value, []).append(refname)
 
-    for oid in base.iter_commits_and_parents({args.oid}):
-        commit = base.get_commit(oid)
-        _print_commit(oid, commit, refs.get(oid))
+    # Commits are walked lazily, so -n only reads as many as it shows
+    stop = None if args.max_count is None else args.skip + args.max_count
+    with _paged_output() as out:
+        for oid in itertools.islice(base.iter_commits_and_parents({args.oid}), args.skip, stop):
+            commit = base.get_commit(oid)
+            out.write(_format_commit(oid, commit, refs.get(oid), args.oneline).encode())
 
 
-def _print_commit(oid, commit, refs: list[str] = None):
+def _format_commit(oid, commit, refs: list[str] = None, oneline=False) -> str:
     refs_str = f' ({", ".join(refs)})' if refs else ''
-    print(f'commit {oid}{refs_str}\n')
-    print(textwrap.indent(commit.message, '    '))
-    print('')
+    if oneline:
+        subject = commit.message.partition('\n')[0]
+        return f'{oid[:10]}{refs_str} {subject}\n'
+    return f'commit {oid}{refs_str}\n\n{textwrap.indent(commit.message, "    ")}\n\n'
+
+
+@contextlib.contextmanager
+def _paged_output():
+    """Binary stream for the output of a command, piped through the pager on a terminal"""
+    sys.stdout.flush()
+    pager = os.environ.get('UGIT_PAGER', os.environ.get('PAGER', 'less'))
+    if not USE_PAGER or not sys.stdout.isatty() or pager in ('', 'cat'):
+        yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
+        return
+
+    # Like git: quit if it fits on one screen, keep colors, don't clear the screen
+    env = {'LESS': 'FRX', **os.environ}
+    with subprocess.Popen(pager, shell=True, stdin=subprocess.PIPE, env=env) as proc:
+        try:
+            yield proc.stdin
+            proc.stdin.close()
+        except BrokenPipeError:
+            # The pager was quit before the end
+            with contextlib.suppress(BrokenPipeError):
+                proc.stdin.close()
 
 
 def show(args):
@@ -155,14 +298,11 @@ def show(args):
         return
     commit = base.get_commit(args.oid)
     parent_tree = None
-    if commit.parents:
+    if commit.parents and args.oid not in data.get_shallow():
         parent_tree = base.get_commit(commit.parents[0]).tree
-    _print_commit(args.oid, commit)
-    result = diff.diff_trees(
-        base.get_tree(parent_tree), base.get_tree(commit.tree)
-    )
-    sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    with _paged_output() as out:
+        out.write(_format_commit(args.oid, commit).encode())
+        out.writelines(diff.diff_trees(parent_tree, commit.tree))
 
 
 def checkout(args):
@@ -185,32 +325,35 @@ def branch(args):
 
 
 def k(args):
-    dot = 'digraph commits {\n'
+    output_file_name = 'graph.png'
+    with subprocess.Popen(
+            ['dot', '-Tpng', f'-o./{output_file_name}'],
+            stdin=subprocess.PIPE
+    ) as proc:
+        # Written as the commits are walked, dot reads it while it comes
+        proc.stdin.writelines(line.encode() for line in _iter_dot())
+
+    print(f'graph available at ./{output_file_name}')
+
+
+def _iter_dot():
+    yield 'digraph commits {\n'
 
     oids = set()
 
     for refname, ref in data.iter_refs(deref=False):
-        dot += f'"{refname}" [shape=note]\n'
-        dot += f'"{refname}" -> "{ref.value}"\n'
+        yield f'"{refname}" [shape=note]\n'
+        yield f'"{refname}" -> "{ref.value}"\n'
         if not ref.symbolic:
             oids.add(ref.value)
 
     for oid in base.iter_commits_and_parents(oids):
         commit = base.get_commit(oid)
-        dot += f'"{oid}" [shape=box style=filled label="{oid[:10]}"]\n'
+        yield f'"{oid}" [shape=box style=filled label="{oid[:10]}"]\n'
         for parent in commit.parents:
-            dot += f'"{oid}" -> "{parent}"\n'
-
-    dot += '}'
-
-    output_file_name = 'graph.png'
-    with subprocess.Popen(
-            ['dot', '-Tpng', f'-o./{output_file_name}'],
-            stdin=subprocess.PIPE
-    ) as proc:
-        proc.communicate(dot.encode())
+            yield f'"{oid}" -> "{parent}"\n'
 
-    print(f'graph available at ./{output_file_name}')
+    yield '}'
 
 
 def status(args):
@@ -227,11 +370,12 @@ def status(args):
 
     print('\nChanges to be committed:\n')
     HEAD_tree = HEAD and base.get_commit(HEAD).tree
-    for path, action in diff.iter_changed_files(base.get_tree(HEAD_tree), base.get_index_tree()):
+    index_tree = base.get_index_tree()
+    for path, action in diff.iter_changed_files(HEAD_tree, index_tree):
         print(f'{action:>12}: {path}')
 
     print('\nChanges not staged for commit:\n')
-    for path, action in diff.iter_changed_files(base.get_index_tree(),
+    for path, action in diff.iter_changed_files(index_tree,
                                                 base.get_working_tree()):
         print(f'{action:>12}: {path}')
 
@@ -249,23 +393,22 @@ def diff_func(args):
 
     if args.commit:
         # If a commit was provided explicitly, diff from it
-        tree_from = base.get_tree(oid and base.get_commit(oid).tree)
+        tree_from = oid and base.get_commit(oid).tree
 
     if args.cached:
         tree_to = base.get_index_tree()
         if not args.commit:
             # If no commit was provided, diff from HEAD
             oid = base.get_oid('@')
-            tree_from = base.get_tree(base.get_commit(oid).tree)
+            tree_from = base.get_commit(oid).tree
     else:
         tree_to = base.get_working_tree()
         if not args.commit:
             # If no commit was provided, diff from index
             tree_from = base.get_index_tree()
 
-    result = diff.diff_trees(tree_from, tree_to)
-    sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    with _paged_output() as out:
+        out.writelines(diff.diff_trees(tree_from, tree_to, to_working_tree=not args.cached))
 
 
 def merge_func(args):
@@ -273,12 +416,62 @@ def merge_func(args):
 
 
 def fetch(args):
-    remote.fetch(args.remote)
+    remote.fetch(args.remote, depth=args.depth, filter_=args.filter)
 
 
 def push(args):
     remote.push(args.remote, f'refs/heads/{args.branch}')
 
 
+def serve(args):
+    if args.socket:
+        print(f'Serving on {transport.SCHEME}://{os.path.abspath(args.socket)}', flush=True)
+        server.serve(args.socket, socket.AF_UNIX)
+    else:
+        print(f'Serving on {transport.SCHEME}://{args.host}:{args.port}', flush=True)
+        server.serve((args.host, args.port))
+
+
 def add(args):
     base.add(args.files)
+
+
+def repack(args):
+    count, name = data.repack(delete_loose=args.delete_loose, all_objects=args.all)
+    print(f'Packed {count} objects')
+    if args.all and name:
+        print(f'Wrote {base.write_bitmaps(name)} bitmaps')
+
+
+def gc(args):
+    stats = base.gc(args.grace_period)
+    saved = stats['size_before'] - stats['size_after']
+    print(f'Packed {stats["objects"]} objects, {stats["deltas"]} as deltas')
+    print(f'Pruned {stats["pruned"]} unreachable loose objects')
+    print(f'Objects took {stats["size_before"]} bytes, now {stats["size_after"]} bytes, saved {saved} bytes')
+
+
+def fsmonitor_func(args):
+    if args.action == 'start':
+        status_ = fsmonitor.start(poll=args.poll)
+        print(f'fsmonitor started with {status_["backend"]}, pid {status_["pid"]}')
+    elif args.action == 'stop':
+        fsmonitor.stop()
+        print('fsmonitor stopped')
+    elif args.action == 'status':
+        status_ = fsmonitor.get_status()
+        if status_:
+            print(f'fsmonitor running with {status_["backend"]}, pid {status_["pid"]}, '
+                  f'{status_["changed_paths"]} changed paths')
+        else:
+            print('fsmonitor not running')
+    else:
+        fsmonitor.run(poll=args.poll)
+
+
+def commit_graph(args):
+    base.update_commit_graph(ref.value for _, ref in data.iter_refs())
+
+
+def pack_refs(args):
+    print(f'Packed {data.pack_refs()} refs')
@@ -0,0 +1,232 @@
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+from typing import Iterator
+
+from . import types, files
+
+SIGNATURE = b'UCGR'
+VERSION = 1
+NO_PARENT = 0xffffffff
+
+# Layout: header, 256 cumulative fan-out counts, sorted binary oids, one fixed
+# width row per commit in the same order, sha1 of everything before it.
+# Rows hold the tree, the positions of up to two parents and the generation:
+# 1 for root commits, otherwise one more than the highest parent generation.
+#
+# Commits added since the graph was written go in layers on top of it, listed in
+# a chain file after the checksum of the graph they extend. A layer has the same
+# layout, its positions follow those of the layers below and its parents may be
+# in any of them. A layer is merged into the one below unless that one has more
+# than twice its commits, so there are only a few of them.
+CHAIN = 'commit-graph-chain'
+_HEADER = struct.Struct('>4sI256I')
+_OID_SIZE = 20
+_ROW = struct.Struct('>20sIII')
+
+
+class CommitGraph:
+    """A graph file, with the layers below it when it is one: positions cover them all"""
+
+    def __init__(self, path, base: 'CommitGraph | None' = None):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, *fanout = _HEADER.unpack_from(self._map)
+        assert signature == SIGNATURE, f'{path} is not a commit graph'
+        assert version == VERSION, f'Unsupported commit graph version {version}'
+        self.path = path
+        self.base = base
+        self._offset = len(base) if base else 0
+        self._fanout = fanout
+        self._oids_start = _HEADER.size
+        self._rows_start = self._oids_start + _OID_SIZE * self.layer_size
+
+    def __len__(self):
+        return self._offset + self._fanout[-1]
+
+    @property
+    def layer_size(self) -> int:
+        """Commits in this file, without the layers below"""
+        return self._fanout[-1]
+
+    @property
+    def checksum(self) -> str:
+        return self._map[-hashlib.sha1().digest_size:].hex()
+
+    def find(self, oid: types.OID) -> int | None:
+        try:
+            key = bytes.fromhex(oid)
+        except ValueError:
+            return None
+        if len(key) != _OID_SIZE:
+            return None
+
+        lo = self._fanout[key[0] - 1] if key[0] else 0
+        hi = self._fanout[key[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self._oid_at(mid)
+            if current < key:
+                lo = mid + 1
+            elif current > key:
+                hi = mid
+            else:
+                return self._offset + mid
+        return self.base.find(oid) if self.base else None
+
+    def _oid_at(self, index) -> bytes:
+        start = self._oids_start + index * _OID_SIZE
+        return self._map[start:start + _OID_SIZE]
+
+    def oid(self, position) -> types.OID:
+        if position < self._offset:
+            return self.base.oid(position)
+        return self._oid_at(position - self._offset).hex()
+
+    def _row(self, position):
+        if position < self._offset:
+            return self.base._row(position)
+        return _ROW.unpack_from(self._map, self._rows_start + (position - self._offset) * _ROW.size)
+
+    def tree(self, position) -> types.OID:
+        return self._row(position)[0].hex()
+
+    def parents(self, position) -> list[int]:
+        _, parent1, parent2, _ = self._row(position)
+        return [parent for parent in (parent1, parent2) if parent != NO_PARENT]
+
+    def generation(self, position) -> int:
+        return self._row(position)[3]
+
+    def iter_commits(self, start=0) -> Iterator[tuple[types.OID, types.OID, list[types.OID]]]:
+        for position in range(start, len(self)):
+            yield self.oid(position), self.tree(position), [self.oid(parent) for parent in self.parents(position)]
+
+
+def read_commit_graph(path) -> CommitGraph | None:
+    """The graph at path with its layers, None when there is none"""
+    if not os.path.isfile(path):
+        return None
+    graph = CommitGraph(path)
+    try:
+        with open(_chain_path(path)) as f:
+            checksum, *names = f.read().split()
+        # Layers left over from before the graph was rewritten don't apply to it
+        if checksum != graph.checksum:
+            return graph
+        layers = graph
+        for name in names:
+            layers = CommitGraph(os.path.join(os.path.dirname(path), name), layers)
+    except (FileNotFoundError, ValueError):
+        # Replaced by a newer chain while reading
+        return graph
+    return layers
+
+
+def write_commit_graph(path, commits: dict[types.OID, tuple[types.OID, list[types.OID]]]):
+    """Write a graph of commits mapped to their tree and parents, parents must be in commits too"""
+    body = _encode(commits, None)
+    # The layers of the old graph go first, they don't apply to the new one
+    _remove_if_exists(_chain_path(path))
+    with files.write_atomic(path) as f:
+        f.write(body + hashlib.sha1(body).digest())
+    _remove_unchained_layers(path, [])
+
+
+def add_commits(path, graph: CommitGraph | None, commits: dict[types.OID, tuple[types.OID, list[types.OID]]]):
+    """Add commits to graph as a layer, their parents must be in commits or graph
+
+    Writes a whole new graph if there is none or the layers end up as big as it.
+    """
+    commits = dict(commits)
+    while graph is not None and graph.layer_size < 2 * len(commits):
+        start = len(graph) - graph.layer_size
+        commits.update((oid, (tree, parents)) for oid, tree, parents in graph.iter_commits(start))
+        graph = graph.base
+    if graph is None:
+        write_commit_graph(path, commits)
+        return
+
+    body = _encode(commits, graph)
+    checksum = hashlib.sha1(body).digest()
+    dirname = os.path.dirname(path)
+    name = f'graph-{checksum.hex()}.graph'
+    with files.write_atomic(os.path.join(dirname, name)) as f:
+        f.write(body + checksum)
+
+    layers = [name]
+    while graph.base is not None:
+        layers.append(os.path.basename(graph.path))
+        graph = graph.base
+    layers.reverse()
+    with files.write_atomic(_chain_path(path), 'w') as f:
+        f.write(''.join(f'{line}\n' for line in [graph.checksum, *layers]))
+    _remove_unchained_layers(path, layers)
+
+
+def _encode(commits, base: CommitGraph | None) -> bytes:
+    offset = len(base) if base else 0
+    oids = sorted(commits)
+    positions = {oid: offset + position for position, oid in enumerate(oids)}
+
+    def get_position(oid):
+        position = positions.get(oid)
+        return base.find(oid) if position is None else position
+
+    generations = {}
+    for oid in oids:
+        # Parents are resolved before their children, without recursing on deep histories
+        stack = [oid]
+        while stack:
+            current = stack[-1]
+            if current in generations:
+                stack.pop()
+                continue
+            if current not in commits:
+                generations[current] = base.generation(base.find(current))
+                continue
+            missing = [parent for parent in commits[current][1] if parent not in generations]
+            if missing:
+                stack.extend(missing)
+                continue
+            generations[current] = 1 + max((generations[parent] for parent in commits[current][1]), default=0)
+            stack.pop()
+
+    counts = [0] * 256
+    for oid in oids:
+        counts[int(oid[:2], 16)] += 1
+
+    parts = [_HEADER.pack(SIGNATURE, VERSION, *itertools.accumulate(counts))]
+    parts.extend(bytes.fromhex(oid) for oid in oids)
+    for oid in oids:
+        tree, parents = commits[oid]
+        assert len(parents) <= 2, f'Commit {oid} has more than two parents'
+        parent1, parent2 = ([get_position(parent) for parent in parents] + [NO_PARENT, NO_PARENT])[:2]
+        parts.append(_ROW.pack(bytes.fromhex(tree), parent1, parent2, generations[oid]))
+    return b''.join(parts)
+
+
+def remove_commit_graph(path):
+    _remove_if_exists(_chain_path(path))
+    _remove_if_exists(path)
+    _remove_unchained_layers(path, [])
+
+
+def _chain_path(path):
+    return os.path.join(os.path.dirname(path), CHAIN)
+
+
+def _remove_unchained_layers(path, layers):
+    dirname = os.path.dirname(path)
+    for name in os.listdir(dirname):
+        if name.startswith('graph-') and name.endswith('.graph') and name not in layers:
+            _remove_if_exists(os.path.join(dirname, name))
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
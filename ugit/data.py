@@ -1,15 +1,32 @@
-import json
 import os
 import hashlib
-import shutil
+import itertools
+import string
+import tempfile
+import time
+import zlib
 from contextlib import contextmanager
-from typing import Iterable
+from typing import Callable, Iterable, Iterator
 
-from ugit import types
+from ugit import types, pack, index, commit_graph, cache, trace, files
 from ugit.types import RefValue
 
 GIT_DIR: str | None = None
 
+CHUNK_SIZE = 64 * 1024
+LOOSE_COMPRESSION = zlib.Z_BEST_SPEED
+
+# Open packs per git dir, so a process touching a remote keeps both mapped
+_packs: dict[str, list[pack.Pack]] = {}
+_commit_graphs: dict[str, commit_graph.CommitGraph | None] = {}
+_ref_tables: dict[str, dict[str, str]] = {}
+_shallow: dict[str, frozenset[types.OID]] = {}
+# Content of objects read whole, streamed reads of large blobs bypass it
+_objects = cache.LRUCache('objects')
+
+# Called with oids missing from a partial clone to get them from its promisor remote
+fetch_missing: Callable[[list[types.OID]], None] | None = None
+
 
 @contextmanager
 def change_git_dir(new_dir):
@@ -20,6 +37,14 @@ def change_git_dir(new_dir):
     GIT_DIR = old_dir
 
 
+def reload():
+    """Forget the refs, packs and commit graph read so far, for long running processes"""
+    _ref_tables.pop(GIT_DIR, None)
+    _shallow.pop(GIT_DIR, None)
+    _get_packs(reload=True)
+    _forget_commit_graph()
+
+
 def init():
     assert GIT_DIR is not None
     os.makedirs(GIT_DIR, exist_ok=True)
@@ -27,53 +52,392 @@ def init():
 
 
 @contextmanager
-def get_index():
-    index = {}
-    index_filepath = f'{GIT_DIR}/index'
-    if os.path.isfile(index_filepath):
-        with open(index_filepath) as f:
-            index = json.load(f)
-    yield index
-
-    with open(index_filepath, 'w') as f:
-        json.dump(index, f)
+def get_index(read_only=False):
+    index_ = index.Index(f'{GIT_DIR}/index', read_only)
+    yield index_
+    if not read_only:
+        index_.write()
 
 
 def hash_object(data: bytes, type_: types.ObjectType = 'blob') -> types.OID:
-    obj = type_.encode() + b'\x00' + data
     oid = hashlib.sha1(data).hexdigest()
-    with open(f'{GIT_DIR}/objects/{oid}', 'wb') as out:
-        out.write(obj)
+    if not object_exists(oid):
+        _install_loose_object(_write_temp_object(type_, [data]), oid)
     return oid
 
 
-def get_object(oid, expected='blob'):
-    with open(f'{GIT_DIR}/objects/{oid}', 'rb') as f:
-        obj = f.read()
+def hash_file(path, type_: types.ObjectType = 'blob', write=True) -> types.OID:
+    # Hash and compress in one pass, so large files never sit in memory
+    hasher = hashlib.sha1()
+    if not write:
+        with open(path, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def iter_chunks():
+        with open(path, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                hasher.update(chunk)
+                yield chunk
+
+    temp_path = _write_temp_object(type_, iter_chunks())
+    oid = hasher.hexdigest()
+    if object_exists(oid):
+        os.remove(temp_path)
+    else:
+        _install_loose_object(temp_path, oid)
+    return oid
+
+
+def _write_temp_object(type_: types.ObjectType, chunks: Iterable[bytes]) -> str:
+    compressor = zlib.compressobj(LOOSE_COMPRESSION)
+    with tempfile.NamedTemporaryFile(dir=f'{GIT_DIR}/objects', prefix='tmp_obj_', delete=False) as out:
+        try:
+            out.write(compressor.compress(type_.encode() + b'\x00'))
+            for chunk in chunks:
+                out.write(compressor.compress(chunk))
+            out.write(compressor.flush())
+        except BaseException:
+            out.close()
+            os.remove(out.name)
+            raise
+    return out.name
 
-    type_, _, content = obj.partition(b'\x00')
-    type_ = type_.decode()
+
+def _install_loose_object(temp_path, oid):
+    trace.count('data.objects_written')
+    if trace.ENABLED:
+        trace.count('data.bytes_written', os.path.getsize(temp_path))
+    path = _loose_path(oid)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    files.replace(temp_path, path, read_only=True)
+
+
+def _loose_path(oid):
+    return f'{GIT_DIR}/objects/{oid[:2]}/{oid[2:]}'
+
+
+def _legacy_loose_path(oid):
+    # Repositories created before compression kept raw objects in a flat directory
+    return f'{GIT_DIR}/objects/{oid}'
+
+
+def get_object(oid, expected='blob'):
+    type_, content = _read_object(oid)
     if expected is not None:
         assert type_ == expected, f'Expected {expected}, got {type_}'
     return content
 
 
+def iter_object(oid, expected='blob') -> Iterator[bytes]:
+    if cached := _objects.get(oid):
+        type_, chunks = cached[0], iter([cached[1]])
+    else:
+        type_, _, chunks = _open_object(oid)
+    if expected is not None:
+        assert type_ == expected, f'Expected {expected}, got {type_}'
+    return chunks
+
+
+def open_object(oid) -> tuple[types.ObjectType, int, Iterator[bytes]]:
+    """Type, size and content of an object, streamed when its size is known without reading it all"""
+    if cached := _objects.get(oid):
+        return cached[0], len(cached[1]), iter([cached[1]])
+    type_, size, chunks = _open_object(oid)
+    if size is None:
+        # Loose objects don't record their size
+        content = b''.join(chunks)
+        return type_, len(content), iter([content])
+    return type_, size, chunks
+
+
+def _read_object(oid) -> tuple[types.ObjectType, bytes]:
+    if cached := _objects.get(oid):
+        return cached
+    type_, _, chunks = _open_object(oid)
+    obj = type_, b''.join(chunks)
+    trace.count('data.bytes_read', len(obj[1]))
+    _objects.put(oid, obj, size=len(obj[1]))
+    return obj
+
+
+def _open_object(oid) -> tuple[types.ObjectType, int | None, Iterator[bytes]]:
+    trace.count('data.objects_read')
+    if found := _find_packed(oid):
+        return _open_packed_object(*found)
+    try:
+        return _open_loose_object(oid)
+    except FileNotFoundError:
+        # The object may have been packed since we last looked
+        if found := _find_packed(oid, reload=True):
+            return _open_packed_object(*found)
+        if not _fetch_missing([oid]):
+            raise
+    found = _find_packed(oid)
+    assert found, f'Object {oid} is missing from the promisor remote too'
+    return _open_packed_object(*found)
+
+
+def prefetch_objects(oids: Iterable[types.OID]):
+    """Get the objects missing from a partial clone in one go, rather than as each is read"""
+    _fetch_missing([oid for oid in dict.fromkeys(oids) if not object_exists(oid)])
+
+
+def _fetch_missing(oids: list[types.OID]) -> bool:
+    if not oids or not fetch_missing or not get_promisor():
+        return False
+    trace.count('data.objects_fetched_lazily', len(oids))
+    fetch_missing(oids)
+    return True
+
+
+def get_promisor() -> str | None:
+    """The remote a partial clone was fetched from, which can provide its missing objects"""
+    path = f'{GIT_DIR}/promisor'
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def set_promisor(remote):
+    with open(f'{GIT_DIR}/promisor', 'w') as f:
+        f.write(f'{remote}\n')
+
+
+def get_shallow() -> frozenset[types.OID]:
+    """Commits whose parents are missing from a shallow clone"""
+    if GIT_DIR not in _shallow:
+        path = f'{GIT_DIR}/shallow'
+        if os.path.isfile(path):
+            with open(path) as f:
+                _shallow[GIT_DIR] = frozenset(f.read().split())
+        else:
+            _shallow[GIT_DIR] = frozenset()
+    return _shallow[GIT_DIR]
+
+
+def set_shallow(oids: Iterable[types.OID]):
+    oids = frozenset(oids)
+    if get_shallow() - oids:
+        # Commits got their parents back, the graph recorded them without any
+        _forget_commit_graph()
+        commit_graph.remove_commit_graph(f'{GIT_DIR}/commit-graph')
+
+    path = f'{GIT_DIR}/shallow'
+    if oids:
+        with files.write_atomic(path, 'w') as f:
+            f.writelines(f'{oid}\n' for oid in sorted(oids))
+    elif os.path.isfile(path):
+        os.remove(path)
+    _shallow[GIT_DIR] = oids
+
+
+def _open_packed_object(pack_: pack.Pack, offset) -> tuple[types.ObjectType, int, Iterator[bytes]]:
+    return pack_.open(offset)
+
+
+def _open_loose_object(oid) -> tuple[types.ObjectType, None, Iterator[bytes]]:
+    if os.path.isfile(_loose_path(oid)):
+        chunks = _iter_loose_chunks(_loose_path(oid), compressed=True)
+    else:
+        chunks = _iter_loose_chunks(_legacy_loose_path(oid), compressed=False)
+
+    header = b''
+    for chunk in chunks:
+        header += chunk
+        if b'\x00' in header:
+            break
+    type_, _, content = header.partition(b'\x00')
+    return type_.decode(), None, itertools.chain([content], chunks)
+
+
+def _iter_loose_chunks(path, compressed) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj() if compressed else None
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield decompressor.decompress(chunk) if decompressor else chunk
+    if decompressor:
+        yield decompressor.flush()
+
+
 def object_exists(oid):
-    return os.path.isfile(f'{GIT_DIR}/objects/{oid}')
+    return (bool(_find_packed(oid)) or
+            os.path.isfile(_loose_path(oid)) or
+            os.path.isfile(_legacy_loose_path(oid)))
+
+
+def _get_packs(reload=False) -> list[pack.Pack]:
+    packs = _packs.get(GIT_DIR)
+    if packs is not None and not reload:
+        return packs
+
+    known = {pack_.name: pack_ for pack_ in packs or []}
+    packs = []
+    pack_dir = f'{GIT_DIR}/objects/pack'
+    if os.path.isdir(pack_dir):
+        for filename in sorted(os.listdir(pack_dir)):
+            name, ext = os.path.splitext(filename)
+            if ext != '.idx' or not os.path.isfile(f'{pack_dir}/{name}.pack'):
+                continue
+            packs.append(known.get(name) or pack.Pack(f'{pack_dir}/{name}'))
+    _packs[GIT_DIR] = packs
+    return packs
+
+
+def _find_packed(oid, reload=False) -> tuple[pack.Pack, int] | None:
+    for pack_ in _get_packs(reload):
+        offset = pack_.find(oid)
+        if offset is not None:
+            return pack_, offset
+    return None
+
+
+def iter_loose_objects() -> Iterable[types.OID]:
+    objects_dir = f'{GIT_DIR}/objects'
+    for name in os.listdir(objects_dir):
+        if len(name) == 2 and _is_hex(name) and os.path.isdir(f'{objects_dir}/{name}'):
+            yield from (name + rest for rest in os.listdir(f'{objects_dir}/{name}')
+                        if len(rest) == 38 and _is_hex(rest))
+        elif len(name) == 40 and _is_hex(name):
+            yield name
+
+
+def _is_hex(name):
+    return all(c in string.hexdigits for c in name)
+
+
+def _remove_loose_object(oid):
+    for path in (_loose_path(oid), _legacy_loose_path(oid)):
+        if os.path.isfile(path):
+            os.remove(path)
+    try:
+        os.rmdir(os.path.dirname(_loose_path(oid)))
+    except OSError:
+        pass  # fan-out directory still has objects
+
+
+@trace.traced
+def repack(delete_loose=False, all_objects=False) -> tuple[int, str | None]:
+    """Pack loose objects, or every object into a single pack, returns the count and the new pack"""
+    loose = sorted(iter_loose_objects())
+    old_packs = _get_packs()
+    if all_objects:
+        to_pack = sorted(set(loose).union(*(pack_.index for pack_ in old_packs)))
+    else:
+        to_pack = [oid for oid in loose if not _find_packed(oid)]
+    name = None
+    if to_pack:
+        name = pack.write_pack(f'{GIT_DIR}/objects/pack', to_pack, _read_object)
+        _get_packs(reload=True)
+
+    if delete_loose:
+        for oid in loose:
+            _remove_loose_object(oid)
+        if all_objects:
+            for pack_ in old_packs:
+                if pack_.name != name:
+                    _remove_pack(pack_)
+            _get_packs(reload=True)
+    return len(to_pack), name
+
+
+def _remove_pack(pack_: pack.Pack):
+    pack_.close()
+    # The index goes first, so readers never find an index without its pack
+    for ext in ('idx', 'bitmap', 'pack'):
+        if os.path.isfile(f'{pack_.base_path}.{ext}'):
+            os.remove(f'{pack_.base_path}.{ext}')
+
+
+def write_delta_pack(oids: list[types.OID], groups: Iterable[list[types.OID]]) -> tuple[str, int]:
+    name, deltas = pack.write_delta_pack(f'{GIT_DIR}/objects/pack', oids, _read_object, groups)
+    _get_packs(reload=True)
+    return name, deltas
+
+
+def iter_packed_objects() -> Iterator[types.OID]:
+    for pack_ in _get_packs():
+        yield from pack_.index
+
+
+def remove_packs(keep):
+    for pack_ in _get_packs():
+        if pack_.name != keep:
+            _remove_pack(pack_)
+    _get_packs(reload=True)
+
+
+def prune_loose_objects(grace_period) -> int:
+    """Remove loose objects now packed, and those older than the grace period, returns how many of those"""
+    pruned = 0
+    cutoff = time.time() - grace_period
+    for oid in list(iter_loose_objects()):
+        if _find_packed(oid):
+            _remove_loose_object(oid)
+            continue
+        path = _loose_path(oid) if os.path.isfile(_loose_path(oid)) else _legacy_loose_path(oid)
+        if os.path.getmtime(path) < cutoff:
+            _remove_loose_object(oid)
+            pruned += 1
+    return pruned
 
 
-def fetch_object_if_missing(oid, remote_git_dir):
-    if object_exists(oid):
-        return
-    remote_git_dir += '/.ugit'
-    shutil.copy(f'{remote_git_dir}/objects/{oid}',
-                f'{GIT_DIR}/objects/{oid}')
+def get_storage_size() -> int:
+    """Bytes taken by loose objects and packs"""
+    return sum(os.path.getsize(f'{dirpath}/{filename}')
+               for dirpath, _, filenames in os.walk(f'{GIT_DIR}/objects')
+               for filename in filenames)
+
+
+def get_pack(name) -> pack.Pack:
+    pack_ = next((pack_ for pack_ in _get_packs() if pack_.name == name), None)
+    assert pack_, f'No pack named {name}'
+    return pack_
+
+
+def get_bitmapped_pack() -> pack.Pack | None:
+    bitmapped = [pack_ for pack_ in _get_packs() if pack_.bitmap]
+    return max(bitmapped, key=lambda pack_: len(pack_.index), default=None)
+
+
+def get_commit_graph() -> commit_graph.CommitGraph | None:
+    if GIT_DIR not in _commit_graphs:
+        _commit_graphs[GIT_DIR] = commit_graph.read_commit_graph(f'{GIT_DIR}/commit-graph')
+    return _commit_graphs[GIT_DIR]
+
 
+def add_to_commit_graph(commits: dict[types.OID, tuple[types.OID, list[types.OID]]]):
+    commit_graph.add_commits(f'{GIT_DIR}/commit-graph', get_commit_graph(), commits)
+    _forget_commit_graph()
 
-def push_object(oid, remote_git_dir):
-    remote_git_dir += '/.ugit'
-    shutil.copy(f'{GIT_DIR}/objects/{oid}',
-                f'{remote_git_dir}/objects/{oid}')
+
+def _forget_commit_graph():
+    # Not closed: other threads of a server may still be reading it, its map goes with the last of them
+    _commit_graphs.pop(GIT_DIR, None)
+
+
+def iter_pack(oids: list[types.OID], jobs=1, progress: pack.Progress = None) -> Iterator[bytes]:
+    return pack.iter_pack_chunks(oids, _read_object, jobs, progress)
+
+
+@trace.traced
+def receive_pack(chunks: Iterable[bytes], progress: pack.Progress = None) -> str:
+    name = pack.index_pack(chunks, f'{GIT_DIR}/objects/pack', progress)
+    _get_packs(reload=True)
+    return name
+
+
+@trace.traced
+def copy_objects(oids: list[types.OID], path, jobs=1, progress: pack.Progress = None) -> str:
+    """Pack objects of this repository straight into the repository at path"""
+    with change_git_dir(path):
+        pack_dir = f'{GIT_DIR}/objects/pack'
+    name = pack.write_pack(pack_dir, oids, _read_object, jobs, progress)
+    with change_git_dir(path):
+        _get_packs(reload=True)
+    return name
 
 
 def update_ref(ref, value: RefValue, deref=True):
@@ -88,6 +452,7 @@ def update_ref(ref, value: RefValue, deref=True):
     os.makedirs(os.path.dirname(ref_path), exist_ok=True)
     with open(ref_path, 'w') as f:
         f.write(value)
+    _get_ref_table()[ref] = value
 
 
 def get_ref(ref, deref=True) -> RefValue:
@@ -96,15 +461,20 @@ def get_ref(ref, deref=True) -> RefValue:
 
 def delete_ref(ref, deref=True):
     ref = _get_ref_internal(ref, deref)[0]
-    os.remove(f'{GIT_DIR}/{ref}')
+    ref_path = f'{GIT_DIR}/{ref}'
+    packed_refs = _read_packed_refs()
+    assert os.path.isfile(ref_path) or ref in packed_refs, f'Unknown ref {ref}'
+    if ref in packed_refs:
+        del packed_refs[ref]
+        _write_packed_refs(packed_refs)
+    if os.path.isfile(ref_path):
+        os.remove(ref_path)
+    _get_ref_table().pop(ref, None)
 
 
 def _get_ref_internal(ref: str, deref: bool) -> tuple[str, RefValue]:
-    ref_path = f'{GIT_DIR}/{ref}'
-    value = None
-    if os.path.isfile(ref_path):
-        with open(ref_path) as f:
-            value = f.read().strip()
+    trace.count('data.ref_reads')
+    value = _get_ref_table().get(ref)
 
     symbolic = bool(value) and value.startswith('ref:')
     if symbolic:
@@ -114,11 +484,64 @@ def _get_ref_internal(ref: str, deref: bool) -> tuple[str, RefValue]:
     return ref, RefValue(symbolic=symbolic, value=value)
 
 
+def _get_ref_table() -> dict[str, str]:
+    # Every ref is read once per process, loose refs override packed ones
+    table = _ref_tables.get(GIT_DIR)
+    if table is None:
+        trace.count('data.ref_tables_loaded')
+        table = _read_packed_refs()
+        refs = ['HEAD', 'MERGE_HEAD']
+        for root, _, filenames in os.walk(f'{GIT_DIR}/refs/'):
+            root = os.path.relpath(root, GIT_DIR).replace('\\', '/')
+            refs.extend(f'{root}/{name}' for name in filenames)
+        for refname in refs:
+            ref_path = f'{GIT_DIR}/{refname}'
+            if os.path.isfile(ref_path):
+                with open(ref_path) as f:
+                    table[refname] = f.read().strip()
+        _ref_tables[GIT_DIR] = table
+    return table
+
+
+def _read_packed_refs() -> dict[str, str]:
+    packed_refs = {}
+    if os.path.isfile(f'{GIT_DIR}/packed-refs'):
+        with open(f'{GIT_DIR}/packed-refs') as f:
+            for line in f:
+                oid, refname = line.rstrip('\n').split(' ', 1)
+                packed_refs[refname] = oid
+    return packed_refs
+
+
+def _write_packed_refs(packed_refs: dict[str, str]):
+    with files.write_atomic(f'{GIT_DIR}/packed-refs', 'w') as f:
+        f.writelines(f'{packed_refs[refname]} {refname}\n' for refname in sorted(packed_refs))
+
+
+def pack_refs() -> int:
+    table = _get_ref_table()
+    packed_refs = {refname: value for refname, value in table.items()
+                   if refname.startswith('refs/') and not value.startswith('ref:')}
+    _write_packed_refs(packed_refs)
+
+    # Loose refs go only once the packed file holds them
+    for refname in packed_refs:
+        ref_path = f'{GIT_DIR}/{refname}'
+        if os.path.isfile(ref_path):
+            os.remove(ref_path)
+        parent = os.path.dirname(refname)
+        while parent != 'refs':
+            try:
+                os.rmdir(f'{GIT_DIR}/{parent}')
+            except OSError:
+                break  # still holds other refs
+            parent = os.path.dirname(parent)
+    return len(packed_refs)
+
+
 def iter_refs(prefix='', deref=True) -> Iterable[tuple[str, types.RefValue]]:
-    refs = ['HEAD', 'MERGE_HEAD']
-    for root, _, filenames in os.walk(f'{GIT_DIR}/refs/'):
-        root = os.path.relpath(root, GIT_DIR).replace('\\', '/')
-        refs.extend(f'{root}/{name}' for name in filenames)
+    table = _get_ref_table()
+    refs = ['HEAD', 'MERGE_HEAD'] + sorted(refname for refname in table if refname.startswith('refs/'))
 
     for refname in refs:
         if not refname.startswith(prefix):
@@ -0,0 +1,123 @@
+# Deltas describe a target as the sizes of the base and the target, then a list
+# of instructions, like git's: a byte with the high bit set copies from the base,
+# its low 4 bits telling which offset bytes follow and the next 3 which size
+# bytes follow, little endian. Any other non-zero byte inserts that many literal
+# bytes that follow it.
+
+BLOCK_SIZE = 16
+_MAX_INSERT = 0x7f
+_MAX_COPY = 0xffffff
+
+
+def create_delta(base: bytes, target: bytes) -> bytes:
+    # Index the base by aligned blocks, then look every target position up
+    blocks = {}
+    for offset in range(0, len(base) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        blocks.setdefault(base[offset:offset + BLOCK_SIZE], offset)
+
+    out = bytearray(_encode_size(len(base)) + _encode_size(len(target)))
+    pending = bytearray()
+    position = 0
+    while position < len(target):
+        base_offset = blocks.get(target[position:position + BLOCK_SIZE])
+        if base_offset is None:
+            pending.append(target[position])
+            position += 1
+            continue
+
+        # Grow the match back over pending literals and forward past the block
+        while pending and base_offset and base[base_offset - 1] == pending[-1]:
+            pending.pop()
+            base_offset -= 1
+            position -= 1
+        length = 0
+        while (position + length < len(target) and base_offset + length < len(base) and
+               target[position + length] == base[base_offset + length]):
+            length += 1
+
+        _emit_insert(out, pending)
+        pending.clear()
+        _emit_copy(out, base_offset, length)
+        position += length
+
+    _emit_insert(out, pending)
+    return bytes(out)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    base_size, position = _decode_size(delta, 0)
+    assert base_size == len(base), 'Delta applied to the wrong base'
+    target_size, position = _decode_size(delta, position)
+
+    out = bytearray()
+    while position < len(delta):
+        opcode = delta[position]
+        position += 1
+        if opcode & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if opcode & (1 << i):
+                    offset |= delta[position] << (8 * i)
+                    position += 1
+            for i in range(3):
+                if opcode & (0x10 << i):
+                    size |= delta[position] << (8 * i)
+                    position += 1
+            out += base[offset:offset + size]
+        else:
+            assert opcode, 'Invalid delta instruction'
+            out += delta[position:position + opcode]
+            position += opcode
+
+    assert len(out) == target_size, 'Delta produced the wrong size'
+    return bytes(out)
+
+
+def _emit_insert(out: bytearray, literal: bytes):
+    for start in range(0, len(literal), _MAX_INSERT):
+        chunk = literal[start:start + _MAX_INSERT]
+        out.append(len(chunk))
+        out += chunk
+
+
+def _emit_copy(out: bytearray, offset, length):
+    while length:
+        size = min(length, _MAX_COPY)
+        opcode = 0x80
+        arguments = bytearray()
+        for i in range(4):
+            byte = (offset >> (8 * i)) & 0xff
+            if byte:
+                opcode |= 1 << i
+                arguments.append(byte)
+        for i in range(3):
+            byte = (size >> (8 * i)) & 0xff
+            if byte:
+                opcode |= 0x10 << i
+                arguments.append(byte)
+        out.append(opcode)
+        out += arguments
+        offset += size
+        length -= size
+
+
+def _encode_size(size) -> bytes:
+    out = bytearray()
+    while True:
+        byte = size & 0x7f
+        size >>= 7
+        if not size:
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+
+def _decode_size(buffer, position) -> tuple[int, int]:
+    size = shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return size, position
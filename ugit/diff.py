@@ -1,14 +1,31 @@
+import difflib
+import os
+import re
 import subprocess
 from collections import defaultdict
-from typing import Iterable, TypeAlias, Literal
+from typing import Iterable, Iterator, TypeAlias, Literal
 from typing_extensions import Unpack
 from tempfile import NamedTemporaryFile as Temp
 
 from . import types
-from . import data
+from . import data, base, trace
 
+# Shell out to diff/diff3 instead of the built-in engine, set by UGIT_EXTERNAL_DIFF or --external-diff
+USE_EXTERNAL_DIFF = bool(os.environ.get('UGIT_EXTERNAL_DIFF'))
+CONTEXT_LINES = 3
+# Only the start of a blob is checked for NUL bytes, like git
+BINARY_CHECK_SIZE = 8000
+# Lines diff --show-c-function takes as the start of a function
+_FUNCTION_LINE = re.compile(rb'[A-Za-z$_]')
 
-def compare_trees(*trees: Unpack[types.TreeMap]) -> Iterable[tuple[types.Path, Unpack[list[types.OID]]]]:
+
+def compare_trees(*trees: Unpack[types.Tree]) -> Iterable[tuple[types.Path, Unpack[list[types.OID]]]]:
+    if not any(isinstance(tree, dict) for tree in trees):
+        # Between tree objects only the subtrees that differ are read, unchanged paths are skipped
+        yield from _compare_tree_objects(trees)
+        return
+
+    trees = [tree if isinstance(tree, dict) else base.get_tree(tree) for tree in trees]
     entries = defaultdict(lambda: [None] * len(trees))
     for i, tree in enumerate(trees):
         for path, oid in tree.items():
@@ -18,18 +35,38 @@ def compare_trees(*trees: Unpack[types.TreeMap]) -> Iterable[tuple[types.Path, U
         yield path, *oids
 
 
-def diff_trees(t_from: types.TreeMap, t_to: types.TreeMap) -> bytes:
-    output = b''
+def _compare_tree_objects(tree_oids: list[types.OID], base_path: types.Path = ''
+                          ) -> Iterator[tuple[types.Path, Unpack[list[types.OID]]]]:
+    if len(set(tree_oids)) == 1:
+        return
+
+    entries = defaultdict(lambda: [None] * len(tree_oids))
+    for i, tree_oid in enumerate(tree_oids):
+        for type_, oid, name in base.iter_tree_entries(tree_oid):
+            entries[name][i] = (type_, oid)
+
+    for name in sorted(entries):
+        path = base_path + name
+        # A name may be a blob on one side and a tree on the other
+        blobs = [entry[1] if entry and entry[0] == 'blob' else None for entry in entries[name]]
+        subtrees = [entry[1] if entry and entry[0] == 'tree' else None for entry in entries[name]]
+        if any(blobs) and len(set(blobs)) > 1:
+            yield path, *blobs
+        if any(subtrees):
+            yield from _compare_tree_objects(subtrees, f'{path}/')
+
+
+def diff_trees(t_from: types.Tree, t_to: types.Tree, to_working_tree=False) -> Iterator[bytes]:
+    """The patch of every changed file, one at a time so it can be written as it comes"""
     for path, o_from, o_to in compare_trees(t_from, t_to):
         if o_from != o_to:
-            output += diff_blobs(o_from, o_to, path)
-    return output
+            yield diff_blobs(o_from, o_to, path, to_working_tree)
 
 
 Action: TypeAlias = Literal['new_file', 'deleted', 'modified']
 
 
-def iter_changed_files(t_from: types.TreeMap, t_to: types.TreeMap) -> Iterable[
+def iter_changed_files(t_from: types.Tree, t_to: types.Tree) -> Iterable[
     tuple[types.Path, Action]]:
     for path, o_from, o_to in compare_trees(t_from, t_to):
         if o_from != o_to:
@@ -39,14 +76,149 @@ def iter_changed_files(t_from: types.TreeMap, t_to: types.TreeMap) -> Iterable[
             yield path, action
 
 
-def diff_blobs(o_from: types.OID, o_to: types.OID, path='blob'):
+def diff_blobs(o_from: types.OID, o_to: types.OID, path='blob', to_working_tree=False) -> bytes:
+    trace.count('diff.blobs_diffed')
+    if USE_EXTERNAL_DIFF:
+        return _diff_blobs_external(o_from, o_to, path, to_working_tree)
+
+    content_from = _read_blob(o_from)
+    # Working tree files are hashed without being stored as objects
+    content_to = _read_blob(o_to, path if to_working_tree else None)
+    if _is_binary(content_from) or _is_binary(content_to):
+        return f'Binary files a/{path} and b/{path} differ\n'.encode()
+    return b''.join(unified_diff(_split_lines(content_from), _split_lines(content_to),
+                                 f'a/{path}', f'b/{path}'))
+
+
+def _read_blob(oid: types.OID, working_path: types.Path = None) -> bytes:
+    if not oid:
+        return b''
+    if working_path:
+        with open(working_path, 'rb') as f:
+            return f.read()
+    return data.get_object(oid)
+
+
+def _is_binary(content: bytes) -> bool:
+    return b'\x00' in content[:BINARY_CHECK_SIZE]
+
+
+def _split_lines(content: bytes) -> list[bytes]:
+    # Only \n ends a line, like diff; the last line may lack it
+    lines = [line + b'\n' for line in content.split(b'\n')]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def unified_diff(a: list[bytes], b: list[bytes], label_from: str, label_to: str) -> Iterator[bytes]:
+    """Same output as `diff --unified --show-c-function`"""
+    # Functions are searched backwards from each hunk, but never twice over the same lines
+    function = b''
+    searched_up_to = 0
+
+    for i, group in enumerate(_group_opcodes(_get_opcodes(a, b))):
+        if i == 0:
+            yield f'--- {label_from}\n+++ {label_to}\n'.encode()
+
+        first, last = group[0], group[-1]
+        start = first[1]
+        for line in reversed(a[searched_up_to:start]):
+            if _FUNCTION_LINE.match(line):
+                function = line
+                break
+        searched_up_to = max(searched_up_to, start)
+
+        yield (f'@@ -{_format_range(first[1], last[2])} +{_format_range(first[3], last[4])} @@'.encode() +
+               _format_function(function) + b'\n')
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                yield from _format_lines(b' ', a[i1:i2])
+                continue
+            if tag in ('replace', 'delete'):
+                yield from _format_lines(b'-', a[i1:i2])
+            if tag in ('replace', 'insert'):
+                yield from _format_lines(b'+', b[j1:j2])
+
+
+def _get_opcodes(a: list[bytes], b: list[bytes]) -> list[tuple[str, int, int, int, int]]:
+    # Most edits are local, only run the matcher between the common prefix and suffix
+    prefix = 0
+    while prefix < min(len(a), len(b)) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(a), len(b)) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+
+    opcodes = []
+    if prefix:
+        opcodes.append(('equal', 0, prefix, 0, prefix))
+    matcher = difflib.SequenceMatcher(None, a[prefix:len(a) - suffix], b[prefix:len(b) - suffix],
+                                      autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        opcodes.append((tag, i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix))
+    if suffix:
+        opcodes.append(('equal', len(a) - suffix, len(a), len(b) - suffix, len(b)))
+    return opcodes
+
+
+def _group_opcodes(opcodes, n=CONTEXT_LINES):
+    # Like difflib.SequenceMatcher.get_grouped_opcodes
+    if not opcodes:
+        return
+    codes = list(opcodes)
+    tag, i1, i2, j1, j2 = codes[0]
+    if tag == 'equal':
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    tag, i1, i2, j1, j2 = codes[-1]
+    if tag == 'equal':
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def _format_range(start, stop):
+    length = stop - start
+    if length == 1:
+        return f'{start + 1}'
+    if not length:
+        return f'{start},0'
+    return f'{start + 1},{length}'
+
+
+def _format_function(line: bytes) -> bytes:
+    # Like diff: leading whitespace skipped, at most 40 bytes, trailing whitespace dropped
+    function = line.rstrip(b'\n').lstrip()[:40].rstrip()
+    return b' ' + function if function else b''
+
+
+def _format_lines(prefix: bytes, lines: list[bytes]) -> Iterator[bytes]:
+    for line in lines:
+        if line.endswith(b'\n'):
+            yield prefix + line
+        else:
+            yield prefix + line + b'\n\\ No newline at end of file\n'
+
+
+def _diff_blobs_external(o_from: types.OID, o_to: types.OID, path='blob', to_working_tree=False) -> bytes:
     with Temp() as f_from, Temp() as f_to:
         for oid, f in [(o_from, f_from), (o_to, f_to)]:
             if oid:
-                f.write(data.get_object(oid))
+                f.write(_read_blob(oid, path if to_working_tree and f is f_to else None))
                 f.flush()
 
-        with subprocess.Popen(
+        trace.count('diff.subprocesses')
+        with trace.span('diff.external_diff'), subprocess.Popen(
                 ['diff', '--unified', '--show-c-function',
                  '--label', f'a/{path}', f_from.name,
                  '--label', f'b/{path}', f_to.name],
@@ -57,22 +229,191 @@ def diff_blobs(o_from: types.OID, o_to: types.OID, path='blob'):
         return output
 
 
-def merge_trees(t_base: types.TreeMap, t_head: types.TreeMap, t_other: types.TreeMap) -> types.TreeMap:
-    tree = {}
+@trace.traced
+def merge_trees(t_base: types.Tree, t_head: types.Tree, t_other: types.Tree
+                ) -> tuple[types.TreeMap, list[types.Path]]:
+    # Start from HEAD, only paths that changed on the other side need merging
+    tree = dict(t_head) if isinstance(t_head, dict) else base.get_tree(t_head)
+    conflicts = []
     for path, o_base, o_HEAD, o_other in compare_trees(t_base, t_head, t_other):
-        merged_obj = merge_blobs(o_base, o_HEAD, o_other)
-        tree[path] = data.hash_object(merged_obj)
-    return tree
+        # Only paths changed differently on both sides need their content merged
+        if o_HEAD == o_other or o_base == o_other:
+            continue
+        if o_base == o_HEAD:
+            merged = o_other
+        else:
+            merged_obj, conflicted = merge_blobs(o_base, o_HEAD, o_other)
+            merged = data.hash_object(merged_obj)
+            if conflicted:
+                conflicts.append(path)
+        if merged:
+            tree[path] = merged
+        else:
+            tree.pop(path, None)
+    return tree, conflicts
+
+
+def merge_blobs(o_base: types.OID, o_head: types.OID, o_other: types.OID) -> tuple[bytes, bool]:
+    trace.count('diff.blobs_merged')
+    if USE_EXTERNAL_DIFF:
+        return _merge_blobs_external(o_base, o_head, o_other)
+
+    ancestor, head, other = (_split_lines(_read_blob(oid)) for oid in (o_base, o_head, o_other))
+    output = []
+    conflicted = False
+    for ancestor_chunk, head_chunk, other_chunk in _iter_merge_regions(ancestor, head, other):
+        if head_chunk == other_chunk or other_chunk == ancestor_chunk:
+            output.extend(head_chunk)
+        elif head_chunk == ancestor_chunk:
+            output.extend(other_chunk)
+        else:
+            conflicted = True
+            output.extend(_format_conflict(ancestor_chunk, head_chunk, other_chunk))
+    return b''.join(output), conflicted
+
+
+def _iter_merge_regions(ancestor: list[bytes], head: list[bytes], other: list[bytes]
+                        ) -> Iterator[tuple[list[bytes], list[bytes], list[bytes]]]:
+    """Split the three versions into aligned chunks, alternating stable and changed ones"""
+    i_ancestor = i_head = i_other = 0
+    for (ancestor_start, ancestor_end, head_start, head_end,
+         other_start, other_end) in _iter_sync_regions(ancestor, head, other):
+        if head_start > i_head or other_start > i_other or ancestor_start > i_ancestor:
+            yield ancestor[i_ancestor:ancestor_start], head[i_head:head_start], other[i_other:other_start]
+        if ancestor_end > ancestor_start:
+            stable = ancestor[ancestor_start:ancestor_end]
+            yield stable, stable, stable
+        i_ancestor, i_head, i_other = ancestor_end, head_end, other_end
+
 
+def _iter_sync_regions(ancestor, head, other):
+    # Ancestor ranges matched unchanged in both sides, like diff3
+    head_matches = _get_matching_blocks(ancestor, head)
+    other_matches = _get_matching_blocks(ancestor, other)
+    i_head = i_other = 0
+    while i_head < len(head_matches) and i_other < len(other_matches):
+        head_base, head_start, head_len = head_matches[i_head]
+        other_base, other_start, other_len = other_matches[i_other]
+        start = max(head_base, other_base)
+        end = min(head_base + head_len, other_base + other_len)
+        if start < end:
+            yield (start, end,
+                   head_start + start - head_base, head_start + end - head_base,
+                   other_start + start - other_base, other_start + end - other_base)
+        if head_base + head_len < other_base + other_len:
+            i_head += 1
+        else:
+            i_other += 1
+    yield len(ancestor), len(ancestor), len(head), len(head), len(other), len(other)
 
-def merge_blobs(o_base: types.OID, o_head: types.OID, o_other: types.OID) -> bytes:
+
+def _get_matching_blocks(a: list[bytes], b: list[bytes]) -> list[tuple[int, int, int]]:
+    # difflib leaves a change among equal lines at the first of them, GNU diff moves it
+    # as diff3 expects. Otherwise the two sides of a merge may keep different copies of
+    # a repeated line, and changes that don't touch look like they overlap.
+    blocks = difflib.SequenceMatcher(None, a, b, autojunk=False).get_matching_blocks()
+    # Padded with an unchanged line at both ends
+    a_changed = [False] + [True] * len(a) + [False]
+    b_changed = [False] + [True] * len(b) + [False]
+    for a_start, b_start, size in blocks:
+        a_changed[a_start + 1:a_start + size + 1] = [False] * size
+        b_changed[b_start + 1:b_start + size + 1] = [False] * size
+    _shift_changes(a, a_changed, b_changed)
+    _shift_changes(b, b_changed, a_changed)
+
+    # The unchanged lines of both sides pair up in order
+    matches = []
+    a_kept = (i for i in range(len(a)) if not a_changed[i + 1])
+    b_kept = (j for j in range(len(b)) if not b_changed[j + 1])
+    for i, j in zip(a_kept, b_kept):
+        if matches and matches[-1][0] + matches[-1][2] == i and matches[-1][1] + matches[-1][2] == j:
+            matches[-1][2] += 1
+        else:
+            matches.append([i, j, 1])
+    return [tuple(match) for match in matches] + [(len(a), len(b), 0)]
+
+
+def _shift_changes(lines: list[bytes], changed: list[bool], other_changed: list[bool]):
+    # GNU diff's shift_boundaries: each run of changed lines slides up, then down, as
+    # far as equal lines allow, merging with the runs it meets, then back up to line up
+    # with a change of the other side if it passed one. Flags are offset by the padding,
+    # j follows the matching position in the other side.
+    end = len(lines)
+    i = j = 0
+    while True:
+        while i < end and not changed[i + 1]:
+            while other_changed[j + 1]:
+                j += 1
+            i += 1
+            j += 1
+        if i == end:
+            return
+        start = i
+        i += 1
+        while changed[i + 1]:
+            i += 1
+        while other_changed[j + 1]:
+            j += 1
+
+        while True:
+            length = i - start
+            while start and lines[start - 1] == lines[i - 1]:
+                start -= 1
+                i -= 1
+                changed[start + 1], changed[i + 1] = True, False
+                while changed[start]:
+                    start -= 1
+                j -= 1
+                while other_changed[j + 1]:
+                    j -= 1
+            corresponding = i if other_changed[j] else end
+            while i != end and lines[start] == lines[i]:
+                changed[start + 1], changed[i + 1] = False, True
+                start += 1
+                i += 1
+                while changed[i + 1]:
+                    i += 1
+                j += 1
+                while other_changed[j + 1]:
+                    j += 1
+                    corresponding = i
+            if length == i - start:
+                break
+
+        while corresponding < i:
+            start -= 1
+            i -= 1
+            changed[start + 1], changed[i + 1] = True, False
+            j -= 1
+            while other_changed[j + 1]:
+                j -= 1
+
+
+def _format_conflict(ancestor_chunk, head_chunk, other_chunk) -> Iterator[bytes]:
+    # Same markers as diff3 -m
+    yield b'<<<<<<< HEAD\n'
+    yield from _terminated(head_chunk)
+    yield b'||||||| BASE\n'
+    yield from _terminated(ancestor_chunk)
+    yield b'=======\n'
+    yield from _terminated(other_chunk)
+    yield b'>>>>>>> MERGE_HEAD\n'
+
+
+def _terminated(lines: list[bytes]) -> Iterator[bytes]:
+    for line in lines:
+        yield line if line.endswith(b'\n') else line + b'\n'
+
+
+def _merge_blobs_external(o_base: types.OID, o_head: types.OID, o_other: types.OID) -> tuple[bytes, bool]:
     with Temp() as f_base, Temp() as f_HEAD, Temp() as f_other:
         for oid, f in [(o_base, f_base), (o_head, f_HEAD), (o_other, f_other)]:
             if oid:
                 f.write(data.get_object(oid))
                 f.flush()
 
-        with subprocess.Popen(
+        trace.count('diff.subprocesses')
+        with trace.span('diff.external_merge'), subprocess.Popen(
                 [
                     'diff3', '-m',
                     '-L', 'HEAD', f_HEAD.name,
@@ -83,4 +424,4 @@ def merge_blobs(o_base: types.OID, o_head: types.OID, o_other: types.OID) -> byt
             output, _ = proc.communicate()
             assert proc.returncode in (0, 1)
 
-        return output
+        return output, proc.returncode == 1
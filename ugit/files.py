@@ -0,0 +1,31 @@
+import contextlib
+import os
+import tempfile
+
+# Read once at import: reading the umask means setting it, which would race with other threads
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+
+def replace(temp_path, path, read_only=False):
+    """Move a finished temporary file to path, with the mode a plain open() would have given it
+
+    Temporary files are created readable by their owner only. Objects, packs and
+    their indexes are never written to again, so they don't get write permission.
+    """
+    os.chmod(temp_path, (0o444 if read_only else 0o666) & ~_UMASK)
+    os.replace(temp_path, path)
+
+
+@contextlib.contextmanager
+def write_atomic(path, mode='wb', read_only=False):
+    """A temporary file next to path that replaces it once written, readers see either version whole"""
+    with tempfile.NamedTemporaryFile(mode, dir=os.path.dirname(path), prefix=f'tmp_{os.path.basename(path)}_',
+                                     delete=False) as f:
+        try:
+            yield f
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    replace(f.name, path, read_only)
@@ -0,0 +1,396 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+import uuid
+from typing import Iterable
+
+from . import data, types, trace, ignore, files
+
+# Seconds a query waits for the monitor, it is treated as not running after that
+TIMEOUT = 2
+_COOKIE_PREFIX = 'fsmonitor-cookie-'
+
+# A token names a monitor process and a query it answered. Every change the
+# monitor sees is stamped with the number of the next query, so a query given a
+# token gets the paths stamped after it. Paths ending with / are directories
+# whose whole content may have changed.
+#
+# Clients keep the token of their last query in the git dir, along with the paths
+# that differed from the index then: those aren't reported again until they change.
+
+
+def query() -> tuple[str, set[types.Path] | None] | None:
+    """The monitor's new token and the paths that may have changed since the saved one
+
+    None when no monitor runs, no paths when the working tree has to be scanned whole.
+    """
+    if not os.path.exists(_socket_path()):
+        return None
+    state = _read_state()
+    try:
+        response = _request({'command': 'query', 'token': state and state['token']})
+    except (OSError, ValueError, AssertionError):
+        return None
+    trace.count('fsmonitor.queries')
+    if response.get('full') or not state:
+        return response['token'], None
+    return response['token'], set(state['dirty']) | set(response['paths'])
+
+
+def save(token: str, dirty: Iterable[types.Path]):
+    """Remember a token, with the paths that differed from the index as of it"""
+    with files.write_atomic(f'{data.GIT_DIR}/fsmonitor-state', 'w') as f:
+        json.dump({'token': token, 'dirty': sorted(dirty)}, f)
+
+
+def mark_dirty(paths: Iterable[types.Path]):
+    """Have the next query report paths, for changes to the index the monitor can't see"""
+    paths = set(paths)
+    state = _read_state()
+    if paths and state:
+        save(state['token'], paths.union(state['dirty']))
+
+
+def _read_state() -> dict | None:
+    try:
+        with open(f'{data.GIT_DIR}/fsmonitor-state') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def start(poll=False) -> dict:
+    assert not get_status(), 'fsmonitor is already running'
+    # The monitor finds ugit where this process did
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')]))}
+    with open(f'{data.GIT_DIR}/fsmonitor.log', 'ab') as log:
+        process = subprocess.Popen(
+            [sys.executable, '-c', 'from ugit.cli import main; main()', 'fsmonitor', 'run',
+             *(['--poll'] if poll else [])],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log, env=env, start_new_session=True)
+
+    deadline = time.monotonic() + 10 * TIMEOUT
+    while time.monotonic() < deadline:
+        assert process.poll() is None, f'fsmonitor exited, see {data.GIT_DIR}/fsmonitor.log'
+        if status := get_status():
+            return status
+        time.sleep(0.05)
+    assert False, 'fsmonitor did not start in time'
+
+
+def stop():
+    assert get_status(), 'fsmonitor is not running'
+    _request({'command': 'stop'})
+    deadline = time.monotonic() + TIMEOUT
+    while os.path.exists(_socket_path()) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def get_status() -> dict | None:
+    if not os.path.exists(_socket_path()):
+        return None
+    try:
+        return _request({'command': 'status'})
+    except (OSError, ValueError):
+        return None
+
+
+def _request(request: dict) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(TIMEOUT)
+        connection.connect(_socket_path())
+        with connection.makefile('rwb') as f:
+            f.write(json.dumps(request).encode() + b'\n')
+            f.flush()
+            response = json.loads(f.readline())
+    assert 'error' not in response, f'fsmonitor: {response["error"]}'
+    return response
+
+
+def _socket_path():
+    # Relative, a socket path can't be longer than about a hundred bytes
+    return f'{data.GIT_DIR}/fsmonitor.sock'
+
+
+def run(poll=False):
+    """Watch the working tree of the current directory and answer queries until stopped"""
+    monitor = _Monitor(poll)
+    path = _socket_path()
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f'fsmonitor {monitor.instance} watching with {monitor.watcher.name}', flush=True)
+    try:
+        while monitor.running:
+            watched = [monitor.watcher.fd] if monitor.watcher.fd is not None else []
+            readable, _, _ = select.select([server, *watched], [], [])
+            if watched and watched[0] in readable:
+                monitor.watcher.read()
+            if server in readable:
+                connection, _ = server.accept()
+                with connection:
+                    monitor.answer(connection)
+    finally:
+        server.close()
+        os.remove(path)
+
+
+class _Monitor:
+    def __init__(self, poll):
+        self.instance = uuid.uuid4().hex[:12]
+        self.running = True
+        # Set once changes may go unseen for good
+        self.failed = False
+        # Stamp of the changes seen now, tokens before valid_since missed some
+        self.seq = 1
+        self.valid_since = 0
+        self.changes: dict[types.Path, int] = {}
+        self.watcher = None if poll else _try_inotify(self)
+        self.watcher = self.watcher or _Poll(self)
+
+    def record(self, path: types.Path):
+        self.changes[path] = self.seq
+
+    def overflow(self):
+        # Changes were lost: every token given so far needs a full scan
+        self.valid_since = self.seq
+
+    def answer(self, connection):
+        connection.settimeout(TIMEOUT)
+        with connection.makefile('rwb') as f:
+            try:
+                request = json.loads(f.readline())
+                response = self._dispatch(request)
+            except (OSError, ValueError, KeyError) as e:
+                response = {'error': str(e)}
+            try:
+                f.write(json.dumps(response).encode() + b'\n')
+                f.flush()
+            except OSError:
+                pass  # the client gave up waiting
+
+    def _dispatch(self, request):
+        if request['command'] == 'query':
+            return self.query(request['token'])
+        if request['command'] == 'status':
+            return {'pid': os.getpid(), 'backend': self.watcher.name, 'token': f'{self.instance}:{self.seq - 1}',
+                    'changed_paths': len(self.changes)}
+        if request['command'] == 'stop':
+            self.running = False
+            return {}
+        raise KeyError(f'Unknown command {request["command"]}')
+
+    def query(self, token: str | None) -> dict:
+        # Only answer once every change made before the query was seen
+        synced = self.watcher.sync()
+        since = self.seq
+        self.seq += 1
+        response = {'token': f'{self.instance}:{since}'}
+
+        instance, _, previous = (token or '').partition(':')
+        if not synced or self.failed or instance != self.instance or int(previous) < self.valid_since:
+            response['full'] = True
+        else:
+            response['paths'] = sorted(path for path, seq in self.changes.items() if seq > int(previous))
+        return response
+
+
+# inotify(7)
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+               _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF)
+_EVENT = struct.Struct('iIII')
+
+
+def _try_inotify(monitor) -> '_Inotify | None':
+    try:
+        return _Inotify(monitor)
+    except (OSError, AttributeError) as e:
+        print(f'inotify unavailable, polling instead: {e}', file=sys.stderr, flush=True)
+        return None
+
+
+class _Inotify:
+    """Watches every directory of the working tree, and the git dir for cookies"""
+    name = 'inotify'
+
+    def __init__(self, monitor: _Monitor):
+        self.monitor = monitor
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # Directory of each watch, relative to the root of the working tree
+        self._dirs: dict[int, types.Path] = {}
+        self._cookies = set()
+        self._cookie_count = 0
+        self._matcher = ignore.Matcher()
+        self._git_dir_watch = self._watch(data.GIT_DIR)
+        self._watch_tree('')
+
+    def _watch(self, path) -> int:
+        watch = self._add_watch(self.fd, os.fsencode(path or '.'), _WATCH_MASK)
+        if watch < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"Can't watch {path or '.'}: {os.strerror(error)}")
+        return watch
+
+    def _watch_tree(self, dirpath: types.Path):
+        # Watch before listing, so nothing created in between goes unnoticed
+        try:
+            watch = self._watch(dirpath)
+            entries = list(os.scandir(dirpath or '.'))
+        except FileNotFoundError:
+            return
+        self._dirs[watch] = dirpath
+        for entry in entries:
+            path = ignore.join(dirpath, entry.name)
+            if entry.is_dir(follow_symlinks=False) and not self._matcher.is_ignored(path, is_dir=True):
+                self._watch_tree(path)
+
+    def _unwatch_tree(self, dirpath: types.Path):
+        for watch, path in list(self._dirs.items()):
+            if path == dirpath or path.startswith(f'{dirpath}/'):
+                self._rm_watch(self.fd, watch)
+                del self._dirs[watch]
+
+    def read(self):
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buffer):
+            watch, mask, _, length = _EVENT.unpack_from(buffer, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            try:
+                self._handle(watch, mask, name)
+            except OSError as e:
+                # Out of watches most likely, a directory goes unwatched from now on
+                print(f'{e}, every query needs a full scan now', file=sys.stderr, flush=True)
+                self.monitor.failed = True
+
+    def _handle(self, watch, mask, name):
+        if mask & _IN_Q_OVERFLOW:
+            self.monitor.overflow()
+            self._watch_tree('')
+            return
+        if watch == self._git_dir_watch:
+            if name.startswith(_COOKIE_PREFIX):
+                self._cookies.add(name)
+            return
+        dirpath = self._dirs.get(watch)
+        if dirpath is None:
+            return
+        if mask & _IN_IGNORED:
+            del self._dirs[watch]
+            return
+        if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+            if not dirpath:
+                print('The working tree is gone, stopping', file=sys.stderr, flush=True)
+                self.monitor.running = False
+            # Otherwise the event on the parent directory reported it
+            return
+
+        path = ignore.join(dirpath, name)
+        if name == ignore.FILENAME:
+            # What is ignored changed, including which directories need a watch
+            self._matcher = ignore.Matcher()
+            self.monitor.overflow()
+            self._watch_tree('')
+            return
+        if self._matcher.is_ignored(path, is_dir=bool(mask & _IN_ISDIR)):
+            return
+        if not mask & _IN_ISDIR:
+            self.monitor.record(path)
+            return
+        if not mask & (_IN_CREATE | _IN_MOVED_TO | _IN_MOVED_FROM | _IN_DELETE):
+            return
+        # Files of a new directory may have been created before it was watched
+        self.monitor.record(f'{path}/')
+        if mask & (_IN_MOVED_FROM | _IN_DELETE):
+            self._unwatch_tree(path)
+        if mask & (_IN_CREATE | _IN_MOVED_TO):
+            self._watch_tree(path)
+
+    def sync(self) -> bool:
+        # Events come in order, once the event of a file created now is read so are all before it
+        self._cookie_count += 1
+        name = f'{_COOKIE_PREFIX}{self._cookie_count}'
+        path = f'{data.GIT_DIR}/{name}'
+        open(path, 'w').close()
+        try:
+            deadline = time.monotonic() + TIMEOUT / 2
+            while name not in self._cookies:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                    return False
+                self.read()
+            return True
+        finally:
+            os.remove(path)
+            self._cookies.discard(name)
+
+
+class _Poll:
+    """Compares the stat data of every file with the previous scan, when queried"""
+    name = 'poll'
+    fd = None
+
+    def __init__(self, monitor: _Monitor):
+        self.monitor = monitor
+        self._stats = self._scan()
+
+    def _scan(self) -> dict[types.Path, tuple[int, int, int, int]]:
+        stats = {}
+        # Fresh patterns every time, a changed .ugitignore shows up as the files it hides or reveals
+        for root, _, filenames in ignore.Matcher().walk():
+            for filename in filenames:
+                path = ignore.join(root, filename)
+                try:
+                    stat = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                stats[path] = (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino)
+        return stats
+
+    def read(self):
+        pass
+
+    def sync(self) -> bool:
+        stats = self._scan()
+        for path in stats.keys() | self._stats.keys():
+            if stats.get(path) != self._stats.get(path):
+                self.monitor.record(path)
+        self._stats = stats
+        return True
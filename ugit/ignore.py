@@ -0,0 +1,208 @@
+import os
+import re
+from typing import Iterable, Iterator, NamedTuple
+
+from . import types
+
+FILENAME = '.ugitignore'
+# Ignored everywhere unless a .ugitignore says otherwise, the git dir always is
+DEFAULT_PATTERNS = ['.ugit', 'venv', 'ugit.egg-info', '__pycache__', '.idea', '.git']
+GIT_DIR_NAME = '.ugit'
+
+# Patterns follow gitignore: '#' starts a comment, '!' re-includes what an earlier
+# pattern ignored, a trailing '/' only matches directories, a '/' at the start or
+# in the middle anchors the pattern to the directory of its file (otherwise it
+# matches a name at any depth), '*' and '?' don't match '/' and '**' matches any
+# number of directories. The last matching pattern wins, patterns of a deeper
+# .ugitignore win over those of its parents, and nothing in an ignored directory
+# can be re-included since it is never looked into.
+
+
+class _Pattern(NamedTuple):
+    regex: str
+    negate: bool
+    dir_only: bool
+
+
+class Matcher:
+    """Tells which paths of the working tree are ignored
+
+    The .ugitignore of each directory is read once, when a path in it is first
+    asked about, so a matcher shouldn't outlive a change to one.
+    """
+
+    def __init__(self, patterns: Iterable[str] = DEFAULT_PATTERNS):
+        self._defaults = _PatternList(patterns)
+        self._lists: dict[types.Path, _PatternList] = {}
+        self._dirs: dict[types.Path, bool] = {}
+
+    def is_ignored(self, path: types.Path, is_dir: bool | None = None) -> bool:
+        """Whether path or a directory above it is ignored, is_dir is looked up when not given"""
+        path = _normalize(path)
+        if not path:
+            return False
+        dirpath, _, _ = path.rpartition('/')
+        if dirpath and self._is_dir_ignored(dirpath):
+            return True
+        if is_dir is None:
+            is_dir = os.path.isdir(path)
+        return self._is_dir_ignored(path) if is_dir else self._matches(path, False)
+
+    def walk(self, top: types.Path = '.') -> Iterator[tuple[types.Path, list[str], list[str]]]:
+        """os.walk of the working tree without the ignored paths, ignored directories aren't entered
+
+        Roots are relative to the working tree, '' for its root.
+        """
+        top = _normalize(top)
+        if top and self._is_dir_ignored(top):
+            return
+        for root, dirnames, filenames in os.walk(top or '.'):
+            root = _normalize(root)
+            dirnames[:] = [name for name in dirnames if not self._is_dir_ignored(join(root, name))]
+            yield root, dirnames, [name for name in filenames if not self._matches(join(root, name), False)]
+
+    def _is_dir_ignored(self, dirpath: types.Path) -> bool:
+        # Parents come first, so every directory of a walk is looked up once
+        ignored = self._dirs.get(dirpath)
+        if ignored is None:
+            parent, _, _ = dirpath.rpartition('/')
+            ignored = bool(parent) and self._is_dir_ignored(parent) or self._matches(dirpath, True)
+            self._dirs[dirpath] = ignored
+        return ignored
+
+    def _matches(self, path: types.Path, is_dir: bool) -> bool:
+        # Only path itself, its directories are known not to be ignored
+        parts = path.split('/')
+        if parts[-1] == GIT_DIR_NAME:
+            return True
+        for depth in range(len(parts) - 1, -1, -1):
+            ignored = self._get_list('/'.join(parts[:depth])).match('/'.join(parts[depth:]), is_dir)
+            if ignored is not None:
+                return ignored
+        return bool(self._defaults.match(path, is_dir))
+
+    def _get_list(self, dirpath: types.Path) -> '_PatternList':
+        patterns = self._lists.get(dirpath)
+        if patterns is None:
+            try:
+                with open(join(dirpath, FILENAME), encoding='utf-8', errors='replace') as f:
+                    patterns = _PatternList(f.read().splitlines())
+            except OSError:
+                patterns = _EMPTY
+            self._lists[dirpath] = patterns
+        return patterns
+
+
+class _PatternList:
+    """The patterns of a file, compiled into one regex for files and one for directories"""
+
+    def __init__(self, lines: Iterable[str]):
+        patterns = [pattern for pattern in map(_parse, lines) if pattern]
+        self._files = _compile([pattern for pattern in patterns if not pattern.dir_only])
+        self._dirs = _compile(patterns)
+
+    def match(self, path: types.Path, is_dir: bool) -> bool | None:
+        """Whether the last pattern matching path ignores it, None when none does"""
+        compiled = self._dirs if is_dir else self._files
+        if compiled is None:
+            return None
+        regex, negated = compiled
+        match = regex.fullmatch(path)
+        if not match:
+            return None
+        return match.lastgroup not in negated
+
+
+def _compile(patterns: list[_Pattern]) -> tuple[re.Pattern, set[str]] | None:
+    # Alternatives are tried in order, so the last pattern goes first
+    if not patterns:
+        return None
+    groups = [(f'p{i}', pattern) for i, pattern in reversed(list(enumerate(patterns)))]
+    regex = re.compile('|'.join(f'(?P<{name}>{pattern.regex})' for name, pattern in groups), re.DOTALL)
+    return regex, {name for name, pattern in groups if pattern.negate}
+
+
+def _parse(line: str) -> _Pattern | None:
+    # Trailing spaces only count when escaped
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '
+    line = stripped
+    if not line or line.startswith('#'):
+        return None
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    anchored = '/' in line
+    regex = _translate(line.lstrip('/'))
+    return _Pattern(regex if anchored else f'(?:.*/)?{regex}', negate, dir_only)
+
+
+def _translate(pattern: str) -> str:
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        at_segment_start = i == 0 or pattern[i - 1] == '/'
+        if at_segment_start and pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif at_segment_start and pattern.startswith('**', i) and i + 2 == n:
+            parts.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif pattern[i] == '[':
+            end = _find_class_end(pattern, i)
+            if end is None:
+                parts.append(re.escape('['))
+                i += 1
+            else:
+                parts.append(_translate_class(pattern[i + 1:end]))
+                i = end + 1
+        elif pattern[i] == '\\' and i + 1 < n:
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(parts)
+
+
+def _find_class_end(pattern: str, start: int) -> int | None:
+    i = start + 1
+    if i < len(pattern) and pattern[i] in '!^':
+        i += 1
+    # A ']' right after the opening one is part of the class
+    if i < len(pattern) and pattern[i] == ']':
+        i += 1
+    end = pattern.find(']', i)
+    return None if end == -1 else end
+
+
+def _translate_class(chars: str) -> str:
+    negate = chars[:1] in ('!', '^')
+    if negate:
+        chars = chars[1:]
+    # A ']' can only be the first member, after the negation
+    chars = chars.replace('\\', '\\\\').replace('[', '\\[').replace(']', '\\]').replace('^', '\\^')
+    return f'[^/{chars}]' if negate else f'[{chars}]'
+
+
+def _normalize(path: types.Path) -> types.Path:
+    path = os.path.relpath(path or '.').replace('\\', '/')
+    return '' if path == '.' else path
+
+
+def join(dirpath: types.Path, name: str) -> types.Path:
+    return f'{dirpath}/{name}' if dirpath else name
+
+
+_EMPTY = _PatternList([])
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import struct
+from collections.abc import MutableMapping
+from typing import Iterator
+
+from . import types, trace, files
+
+SIGNATURE = b'UIDX'
+VERSION = 1
+
+# Layout: header, entries sorted by path, extensions, sha1 of everything before it.
+# Each entry stores its path as the length of the prefix it shares with the
+# previous path followed by the remaining suffix. Extensions are a signature and
+# a length followed by their payload, unknown ones are skipped.
+_HEADER = struct.Struct('>4sII')
+_ENTRY = struct.Struct('>qqqQ20sHH')
+_EXTENSION = struct.Struct('>4sI')
+_CHECKSUM_SIZE = 20
+
+# Cache-tree extension: tree oids of directories whose entries haven't changed since
+CACHE_TREE_SIGNATURE = b'TREE'
+_CACHE_TREE_ENTRY = struct.Struct('>20sH')
+
+
+class Index(MutableMapping):
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self._entries: dict[types.Path, types.IndexEntry] | None = None
+        self._cache_tree: dict[types.Path, types.OID] = {}
+        self._dirty = False
+
+    @property
+    def _loaded(self) -> dict[types.Path, types.IndexEntry]:
+        # Parsing is deferred until an entry is actually needed
+        if self._entries is None:
+            with trace.span('index.read'):
+                self._entries, self._cache_tree = self._load()
+        return self._entries
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}, {}
+        with open(self.path, 'rb') as f:
+            raw = f.read()
+
+        if raw.startswith(b'{'):
+            # Index written as JSON by older versions, rewritten as binary on the next write
+            self._dirty = True
+            return {path: types.IndexEntry(*entry) if isinstance(entry, list) else types.IndexEntry(entry)
+                    for path, entry in json.loads(raw).items()}, {}
+        return _parse(raw)
+
+    def __getitem__(self, path: types.Path) -> types.IndexEntry:
+        return self._loaded[path]
+
+    def __setitem__(self, path: types.Path, entry: types.IndexEntry):
+        assert not self.read_only, 'Index was opened read-only'
+        previous = self._loaded.get(path)
+        if previous != entry:
+            if previous is None or previous.oid != entry.oid:
+                self._invalidate_cached_trees(path)
+            self._loaded[path] = entry
+            self._dirty = True
+
+    def __delitem__(self, path: types.Path):
+        assert not self.read_only, 'Index was opened read-only'
+        del self._loaded[path]
+        self._invalidate_cached_trees(path)
+        self._dirty = True
+
+    def __iter__(self) -> Iterator[types.Path]:
+        return iter(self._loaded)
+
+    def __len__(self):
+        return len(self._loaded)
+
+    def __contains__(self, path):
+        return path in self._loaded
+
+    def items(self):
+        return self._loaded.items()
+
+    def clear(self):
+        assert not self.read_only, 'Index was opened read-only'
+        if self._loaded or self._cache_tree:
+            self._loaded.clear()
+            self._cache_tree.clear()
+            self._dirty = True
+
+    def get_cached_tree(self, dirpath: types.Path) -> types.OID | None:
+        """Tree oid of a directory ('' for the root), if none of its entries changed since it was set"""
+        _ = self._loaded
+        return self._cache_tree.get(dirpath)
+
+    def cached_trees(self) -> dict[types.Path, types.OID]:
+        _ = self._loaded
+        return dict(self._cache_tree)
+
+    def set_cached_tree(self, dirpath: types.Path, oid: types.OID):
+        assert not self.read_only, 'Index was opened read-only'
+        _ = self._loaded
+        if self._cache_tree.get(dirpath) != oid:
+            self._cache_tree[dirpath] = oid
+            self._dirty = True
+
+    def _invalidate_cached_trees(self, path: types.Path):
+        # Every directory up to the root holds the changed path
+        dirpath = path
+        while dirpath:
+            dirpath = os.path.dirname(dirpath)
+            self._cache_tree.pop(dirpath, None)
+
+    def write(self):
+        if not self._dirty:
+            return
+        assert not self.read_only, 'Index was opened read-only'
+        self._write_file()
+
+        # A file modified in the same timestamp tick as the index was written can't be
+        # told apart from its indexed version by stat, so force it to be rehashed
+        index_mtime_ns = os.stat(self.path).st_mtime_ns
+        racy = [path for path, entry in self._loaded.items() if entry.mtime_ns >= index_mtime_ns]
+        if racy:
+            for path in racy:
+                self._loaded[path] = self._loaded[path]._replace(mtime_ns=0)
+            self._write_file()
+        self._dirty = False
+
+    def _write_file(self):
+        with trace.span('index.write'):
+            with files.write_atomic(self.path) as f:
+                f.write(_serialize(self._loaded, self._cache_tree))
+
+
+def _parse(raw: bytes) -> tuple[dict[types.Path, types.IndexEntry], dict[types.Path, types.OID]]:
+    body, checksum = raw[:-_CHECKSUM_SIZE], raw[-_CHECKSUM_SIZE:]
+    assert hashlib.sha1(body).digest() == checksum, 'Index checksum mismatch'
+    signature, version, count = _HEADER.unpack_from(body)
+    assert signature == SIGNATURE, 'Not an index file'
+    assert version == VERSION, f'Unsupported index version {version}'
+
+    entries = {}
+    offset = _HEADER.size
+    path = b''
+    for _ in range(count):
+        size, mtime_ns, ctime_ns, ino, oid, prefix_len, suffix_len = _ENTRY.unpack_from(body, offset)
+        offset += _ENTRY.size
+        path = path[:prefix_len] + body[offset:offset + suffix_len]
+        offset += suffix_len
+        entries[path.decode()] = types.IndexEntry(oid.hex(), size, mtime_ns, ctime_ns, ino)
+
+    cache_tree = {}
+    while offset < len(body):
+        signature, length = _EXTENSION.unpack_from(body, offset)
+        offset += _EXTENSION.size
+        if signature == CACHE_TREE_SIGNATURE:
+            cache_tree = _parse_cache_tree(body[offset:offset + length])
+        offset += length
+    return entries, cache_tree
+
+
+def _parse_cache_tree(payload: bytes) -> dict[types.Path, types.OID]:
+    cache_tree = {}
+    offset = 0
+    while offset < len(payload):
+        oid, path_len = _CACHE_TREE_ENTRY.unpack_from(payload, offset)
+        offset += _CACHE_TREE_ENTRY.size
+        cache_tree[payload[offset:offset + path_len].decode()] = oid.hex()
+        offset += path_len
+    return cache_tree
+
+
+def _serialize(entries: dict[types.Path, types.IndexEntry], cache_tree: dict[types.Path, types.OID]) -> bytes:
+    parts = [_HEADER.pack(SIGNATURE, VERSION, len(entries))]
+    previous = b''
+    for path in sorted(entries):
+        entry = entries[path]
+        encoded = path.encode()
+        prefix_len = min(len(os.path.commonprefix([previous, encoded])), 0xffff)
+        suffix = encoded[prefix_len:]
+        parts.append(_ENTRY.pack(entry.size, entry.mtime_ns, entry.ctime_ns, entry.ino,
+                                 bytes.fromhex(entry.oid), prefix_len, len(suffix)))
+        parts.append(suffix)
+        previous = encoded
+
+    if cache_tree:
+        payload = b''.join(_CACHE_TREE_ENTRY.pack(bytes.fromhex(cache_tree[dirpath]), len(dirpath.encode())) +
+                           dirpath.encode()
+                           for dirpath in sorted(cache_tree))
+        parts.append(_EXTENSION.pack(CACHE_TREE_SIGNATURE, len(payload)) + payload)
+
+    body = b''.join(parts)
+    return body + hashlib.sha1(body).digest()
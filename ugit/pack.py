@@ -0,0 +1,444 @@
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+from . import types, bitmap, cache, delta, trace, files
+
+Reader = Callable[[types.OID], tuple[types.ObjectType, bytes]]
+# Called with the number of objects done so far and the total
+Progress = Callable[[int, int], None] | None
+
+PACK_SIGNATURE = b'UPCK'
+INDEX_SIGNATURE = b'UPIX'
+VERSION = 1
+CHUNK_SIZE = 64 * 1024
+# Objects encoded ahead of the writer per thread, bounds the memory in flight
+_WINDOW_PER_JOB = 4
+
+TYPE_CODES: dict[types.ObjectType, int] = {'blob': 1, 'tree': 2, 'commit': 3}
+TYPE_NAMES: dict[int, types.ObjectType] = {code: type_ for type_, code in TYPE_CODES.items()}
+# Followed by the oid of the base object, which must be in the same pack, then the
+# compressed delta. Only written by gc, packs sent to remotes hold whole objects,
+# but index_pack takes both.
+REF_DELTA = 7
+MAX_DELTA_DEPTH = 10
+# Objects each one is tried against as a delta base
+DELTA_WINDOW = 10
+
+# Objects resolved from deltas, often the base of the next one read
+_delta_bases = cache.LRUCache('delta bases')
+
+# Index layout: signature, version, 256 cumulative fan-out counts, sorted binary
+# oids, pack offsets in the same order, pack checksum, index checksum
+_INDEX_HEADER = struct.Struct('>4sI256I')
+_OID_SIZE = 20
+_OFFSET = struct.Struct('>Q')
+_PACK_HEADER = struct.Struct('>4sII')
+
+
+class PackIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, *fanout = _INDEX_HEADER.unpack_from(self._map)
+        assert signature == INDEX_SIGNATURE, f'{path} is not a pack index'
+        assert version == VERSION, f'Unsupported pack index version {version}'
+        self._fanout = fanout
+        self._oids_start = _INDEX_HEADER.size
+        self._offsets_start = self._oids_start + _OID_SIZE * len(self)
+
+    def __len__(self):
+        return self._fanout[-1]
+
+    def __iter__(self) -> Iterator[types.OID]:
+        for i in range(len(self)):
+            yield self._oid_at(i).hex()
+
+    def _oid_at(self, i):
+        start = self._oids_start + i * _OID_SIZE
+        return self._map[start:start + _OID_SIZE]
+
+    def oid(self, position) -> types.OID:
+        return self._oid_at(position).hex()
+
+    def position(self, oid: types.OID) -> int | None:
+        """Rank of the oid in the index, the bit that stands for it in bitmaps"""
+        try:
+            key = bytes.fromhex(oid)
+        except ValueError:
+            return None
+        if len(key) != _OID_SIZE:
+            return None
+
+        lo = self._fanout[key[0] - 1] if key[0] else 0
+        hi = self._fanout[key[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self._oid_at(mid)
+            if current < key:
+                lo = mid + 1
+            elif current > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def find(self, oid: types.OID) -> int | None:
+        position = self.position(oid)
+        if position is None:
+            return None
+        return _OFFSET.unpack_from(self._map, self._offsets_start + position * _OFFSET.size)[0]
+
+    def close(self):
+        self._map.close()
+
+
+class Pack:
+    def __init__(self, base_path):
+        self.name = os.path.basename(base_path)
+        self.base_path = base_path
+        self.index = PackIndex(f'{base_path}.idx')
+        self._path = f'{base_path}.pack'
+        self._data = None
+        self._bitmap = None
+
+    @property
+    def bitmap(self) -> bitmap.BitmapIndex | None:
+        if self._bitmap is None:
+            path = f'{self.base_path}.bitmap'
+            self._bitmap = bitmap.BitmapIndex(path) if os.path.isfile(path) else False
+        return self._bitmap or None
+
+    def write_bitmap(self, bitmaps: dict[types.OID, int]):
+        bitmap.write_bitmaps(f'{self.base_path}.bitmap', bytes.fromhex(self.name[len('pack-'):]), bitmaps)
+        self._bitmap = None
+
+    def find(self, oid: types.OID) -> int | None:
+        return self.index.find(oid)
+
+    def open(self, offset) -> tuple[types.ObjectType, int, Iterator[bytes]]:
+        if self._data is None:
+            with open(self._path, 'rb') as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        type_code, size, data_offset = _decode_entry_header(self._data, offset)
+        if type_code != REF_DELTA:
+            return TYPE_NAMES[type_code], size, _iter_inflated(self._data, data_offset, size)
+        type_, content = _resolve_delta(self.name, self._data, offset, self.index.find)
+        return type_, len(content), iter([content])
+
+    def close(self):
+        self.index.close()
+        if self._data is not None:
+            self._data.close()
+
+
+class PackWriter:
+    def __init__(self, pack_dir, count):
+        os.makedirs(pack_dir, exist_ok=True)
+        self.name = None
+        self._pack_dir = pack_dir
+        self._count = count
+        self._file = tempfile.NamedTemporaryFile(dir=pack_dir, prefix='tmp_pack_', delete=False)
+        self._hasher = hashlib.sha1()
+        self._offset = 0
+        self._entries = []
+        self._write(_PACK_HEADER.pack(PACK_SIGNATURE, VERSION, count))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self._file.close()
+            os.remove(self._file.name)
+
+    def _write(self, data):
+        self._hasher.update(data)
+        self._file.write(data)
+        self._offset += len(data)
+
+    def add(self, oid: types.OID, type_: types.ObjectType, content: bytes):
+        self._add_entry(oid, _encode_entry(type_, content))
+
+    def add_delta(self, oid: types.OID, base_oid: types.OID, delta_: bytes):
+        """Store an object as a delta against another object of the same pack"""
+        self._add_entry(oid, _encode_entry_header(REF_DELTA, len(delta_)) + bytes.fromhex(base_oid) +
+                        zlib.compress(delta_))
+
+    def _add_entry(self, oid: types.OID, entry: bytes):
+        self._entries.append((bytes.fromhex(oid), self._offset))
+        self._write(entry)
+
+    def finish(self) -> str:
+        assert len(self._entries) == self._count, \
+            f'Expected {self._count} objects, got {len(self._entries)}'
+        trace.count('pack.objects_written', len(self._entries))
+        trace.count('pack.bytes_written', self._offset)
+        checksum = self._hasher.digest()
+        self._file.write(checksum)
+        self._file.close()
+
+        base_path = f'{self._pack_dir}/pack-{checksum.hex()}'
+        files.replace(self._file.name, f'{base_path}.pack', read_only=True)
+        # The index is written last, readers only look for packs through it
+        _write_index(f'{base_path}.idx', self._entries, checksum)
+        self.name = os.path.basename(base_path)
+        return self.name
+
+
+@trace.traced
+def write_pack(pack_dir, oids: list[types.OID], read: Reader, jobs=1, progress: Progress = None) -> str:
+    with PackWriter(pack_dir, len(oids)) as writer:
+        for oid, entry in _iter_entries(oids, read, jobs, progress):
+            writer._add_entry(oid, entry)
+    return writer.name
+
+
+@trace.traced
+def write_delta_pack(pack_dir, oids: list[types.OID], read: Reader,
+                     groups: Iterable[list[types.OID]]) -> tuple[str, int]:
+    """Pack objects, those similar to others of their group as deltas, returns the name and delta count"""
+    deltas = {}
+    for group in groups:
+        deltas.update(_find_deltas(group, read))
+    with PackWriter(pack_dir, len(oids)) as writer:
+        for oid in oids:
+            if oid in deltas:
+                writer.add_delta(oid, *deltas[oid])
+            else:
+                writer.add(oid, *read(oid))
+    return writer.name, len(deltas)
+
+
+def _find_deltas(group: list[types.OID], read: Reader) -> dict[types.OID, tuple[types.OID, bytes]]:
+    # Like git, go from the largest object down and try each against the few
+    # before it, so bases tend to be the larger, usually newer, versions
+    sizes = {oid: len(read(oid)[1]) for oid in group}
+    deltas = {}
+    depths = {}
+    window = deque(maxlen=DELTA_WINDOW)
+    for oid in sorted(group, key=lambda oid: (-sizes[oid], oid)):
+        content = read(oid)[1]
+        best = None
+        for base_oid, base in window:
+            if depths[base_oid] >= MAX_DELTA_DEPTH or len(base) > 2 * len(content) + delta.BLOCK_SIZE:
+                continue
+            delta_ = delta.create_delta(base, content)
+            # Not worth it unless it saves at least half of the object
+            if len(delta_) < (len(best[1]) if best else len(content) // 2):
+                best = base_oid, delta_
+        if best:
+            deltas[oid] = best
+        depths[oid] = depths[best[0]] + 1 if best else 0
+        window.append((oid, content))
+    return deltas
+
+
+def iter_pack_chunks(oids: list[types.OID], read: Reader, jobs=1, progress: Progress = None) -> Iterator[bytes]:
+    """Stream a pack of the given objects, without writing it anywhere"""
+    hasher = hashlib.sha1()
+    header = _PACK_HEADER.pack(PACK_SIGNATURE, VERSION, len(oids))
+    hasher.update(header)
+    yield header
+    for _, entry in _iter_entries(oids, read, jobs, progress):
+        hasher.update(entry)
+        yield entry
+    yield hasher.digest()
+
+
+def _iter_entries(oids: list[types.OID], read: Reader, jobs, progress: Progress) -> Iterator[tuple[types.OID, bytes]]:
+    # Objects are read and compressed by up to jobs threads, a bounded window
+    # ahead of the consumer, and come out in order
+    def encode(oid):
+        return _encode_entry(*read(oid))
+
+    if jobs <= 1 or len(oids) < jobs * _WINDOW_PER_JOB:
+        entries = map(encode, oids)
+    else:
+        entries = _map_ahead(encode, oids, jobs)
+    for done, (oid, entry) in enumerate(zip(oids, entries), 1):
+        if progress:
+            progress(done, len(oids))
+        yield oid, entry
+
+
+def _map_ahead(function, items, jobs) -> Iterator:
+    with ThreadPoolExecutor(jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(function, item))
+            if len(pending) >= jobs * _WINDOW_PER_JOB:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+@trace.traced
+def index_pack(chunks: Iterable[bytes], pack_dir, progress: Progress = None) -> str:
+    """Store a pack stream as it arrives, then index it by hashing each object once"""
+    os.makedirs(pack_dir, exist_ok=True)
+    # Nothing is visible to readers before the pack is complete and indexed
+    out = tempfile.NamedTemporaryFile(dir=pack_dir, prefix='tmp_pack_', delete=False)
+    try:
+        with out:
+            for chunk in chunks:
+                out.write(chunk)
+        with open(out.name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            entries, checksum = _index_pack_entries(buffer, progress)
+    except BaseException:
+        os.remove(out.name)
+        raise
+
+    base_path = f'{pack_dir}/pack-{checksum.hex()}'
+    files.replace(out.name, f'{base_path}.pack', read_only=True)
+    _write_index(f'{base_path}.idx', entries, checksum)
+    return os.path.basename(base_path)
+
+
+def _resolve_delta(name, buffer, offset, find: Callable[[types.OID], int | None]) -> tuple[types.ObjectType, bytes]:
+    # Follow the chain down to a full object or a recently resolved base,
+    # then apply the deltas back up
+    chain = []
+    while True:
+        if cached := _delta_bases.get((name, offset)):
+            type_, content = cached
+            break
+        type_code, size, data_offset = _decode_entry_header(buffer, offset)
+        if type_code != REF_DELTA:
+            type_, content = TYPE_NAMES[type_code], b''.join(_iter_inflated(buffer, data_offset, size))
+            if chain:
+                _delta_bases.put((name, offset), (type_, content), size=len(content))
+            break
+        chain.append((offset, data_offset + _OID_SIZE, size))
+        base_oid = buffer[data_offset:data_offset + _OID_SIZE].hex()
+        offset = find(base_oid)
+        assert offset is not None, f'Delta base {base_oid} missing from {name}'
+
+    trace.count('pack.deltas_applied', len(chain))
+    for delta_offset, data_offset, size in reversed(chain):
+        content = delta.apply_delta(content, b''.join(_iter_inflated(buffer, data_offset, size)))
+        _delta_bases.put((name, delta_offset), (type_, content), size=len(content))
+    return type_, content
+
+
+def _iter_inflated(buffer, offset, size):
+    decompressor = zlib.decompressobj()
+    # Most entries fit in the first read, so don't over-read small objects
+    step = min(size + 64, CHUNK_SIZE)
+    while not decompressor.eof:
+        chunk = buffer[offset:offset + step]
+        assert chunk, f'Truncated entry at offset {offset}'
+        offset += len(chunk)
+        step = CHUNK_SIZE
+        yield decompressor.decompress(chunk)
+
+
+def _index_pack_entries(buffer, progress: Progress) -> tuple[list[tuple[bytes, int]], bytes]:
+    assert len(buffer) >= _PACK_HEADER.size + _OID_SIZE, 'Truncated pack'
+    checksum = buffer[-_OID_SIZE:]
+    assert hashlib.sha1(buffer[:-_OID_SIZE]).digest() == checksum, 'Pack checksum mismatch'
+    signature, version, count = _PACK_HEADER.unpack_from(buffer)
+    assert signature == PACK_SIGNATURE, 'Not a pack'
+    assert version == VERSION, f'Unsupported pack version {version}'
+
+    end = len(buffer) - _OID_SIZE
+    entries = []
+    deltas = []
+    offset = _PACK_HEADER.size
+    for done in range(1, count + 1):
+        type_code, size, position = _decode_entry_header(buffer, offset)
+        assert type_code in TYPE_NAMES or type_code == REF_DELTA, \
+            f'Unknown object type {type_code} at offset {offset}'
+        if type_code == REF_DELTA:
+            deltas.append((offset, buffer[position:position + _OID_SIZE].hex()))
+            position += _OID_SIZE
+        hasher = hashlib.sha1()
+        inflated = 0
+        decompressor = zlib.decompressobj()
+        step = min(size + 64, CHUNK_SIZE)
+        while not decompressor.eof:
+            chunk = buffer[position:min(position + step, end)]
+            assert chunk, f'Truncated entry at offset {offset}'
+            position += len(chunk)
+            step = CHUNK_SIZE
+            content = decompressor.decompress(chunk)
+            hasher.update(content)
+            inflated += len(content)
+        assert inflated == size, f'Corrupt entry at offset {offset}'
+        if type_code != REF_DELTA:
+            entries.append((hasher.digest(), offset))
+        offset = position - len(decompressor.unused_data)
+        if progress:
+            progress(done, count)
+    assert offset == end, 'Trailing data in pack'
+
+    # A delta is hashed once its base is, which may come later in the pack
+    name = f'pack-{checksum.hex()}'
+    offsets = {oid.hex(): offset for oid, offset in entries}
+    while deltas:
+        ready = [offset for offset, base_oid in deltas if base_oid in offsets]
+        assert ready, f'Delta base {deltas[0][1]} missing from the pack'
+        deltas = [(offset, base_oid) for offset, base_oid in deltas if base_oid not in offsets]
+        for offset in ready:
+            oid = hashlib.sha1(_resolve_delta(name, buffer, offset, offsets.get)[1]).digest()
+            entries.append((oid, offset))
+            offsets[oid.hex()] = offset
+    trace.count('pack.objects_indexed', count)
+    trace.count('pack.bytes_indexed', len(buffer))
+    return entries, checksum
+
+
+def _write_index(path, entries: Iterable[tuple[bytes, int]], pack_checksum: bytes):
+    entries = sorted(entries)
+    counts = [0] * 256
+    for oid, _ in entries:
+        counts[oid[0]] += 1
+
+    index = _INDEX_HEADER.pack(INDEX_SIGNATURE, VERSION, *itertools.accumulate(counts))
+    index += b''.join(oid for oid, _ in entries)
+    index += b''.join(_OFFSET.pack(offset) for _, offset in entries)
+    index += pack_checksum
+    index += hashlib.sha1(index).digest()
+
+    with files.write_atomic(path, read_only=True) as f:
+        f.write(index)
+
+
+def _encode_entry(type_: types.ObjectType, content: bytes) -> bytes:
+    return _encode_entry_header(TYPE_CODES[type_], len(content)) + zlib.compress(content)
+
+
+def _encode_entry_header(type_code, size):
+    # Like git: 3 bits of type and 4 bits of size, then 7 bits of size per byte
+    header = bytearray()
+    byte = (type_code << 4) | (size & 0x0f)
+    size >>= 4
+    while size:
+        header.append(byte | 0x80)
+        byte = size & 0x7f
+        size >>= 7
+    header.append(byte)
+    return bytes(header)
+
+
+def _decode_entry_header(buffer, offset):
+    byte = buffer[offset]
+    offset += 1
+    type_code = (byte >> 4) & 0x07
+    size = byte & 0x0f
+    shift = 4
+    while byte & 0x80:
+        byte = buffer[offset]
+        offset += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+    return type_code, size, offset
@@ -1,29 +1,58 @@
 import os
+import sys
 
-from . import data, base
+from . import data, base, transport, trace
 
 REMOTE_REFS_BASE = 'refs/heads/'
 LOCAL_REFS_BASE = 'refs/remote'
 
+# Attempts of each exchange with a remote, reconnecting after a failure
+RETRIES = 3
+
+
+@trace.traced
+def fetch(remote, depth: int | None = None, filter_: str | None = None):
+    assert filter_ in (None, 'blob:none'), f'Unsupported filter {filter_}'
+    assert depth is None or depth > 0, 'Depth must be positive'
+    blobs = filter_ is None
+    if not blobs:
+        # Remember where to get the blobs from once they're needed
+        data.set_promisor(remote)
 
-def fetch(remote_path):
     # Get refs from server
-    refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
+    refs = _retry(remote, 'list_refs', lambda connection: connection.list_refs(REMOTE_REFS_BASE))
+
+    # Find the commits we already share with the server, from the tips of our refs.
+    # A shallow clone tells where its history ends too, so the server sends what
+    # lies beyond when deepening.
+    shallow = data.get_shallow()
+    local_tips = [ref.value for _, ref in data.iter_refs()]
+    known = [oid for oid in refs.values() if data.object_exists(oid)]
+    common = _retry(remote, 'negotiate',
+                    lambda connection: base.find_common_commits(local_tips, connection.has_objects, known))
 
-    # Fetch missing objects by iterating and fetching on demand
-    for oid in base.iter_objects_in_commits(refs.values()):
-        data.fetch_object_if_missing(oid, remote_path)
+    # Receive everything made since as a single pack
+    wants = [oid for oid in dict.fromkeys(refs.values()) if shallow or depth or not data.object_exists(oid)]
+    trace.count('remote.wants', len(wants))
+    if wants:
+        boundary = _retry(remote, 'fetch_pack', lambda connection: connection.fetch_pack(
+            wants, common, depth, blobs, base.JOBS, _progress('Receiving objects'), shallow))
+        # Commits stay shallow until their parents arrive
+        data.set_shallow(oid for oid in shallow | boundary
+                         if not all(map(data.object_exists, base.get_commit(oid).parents)))
 
     # Update local refs to match server
     for remote_name, value in refs.items():
         refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
         data.update_ref(f'{LOCAL_REFS_BASE}/{refname}',
                         data.RefValue(symbolic=False, value=value))
+    base.update_commit_graph(refs.values())
 
 
-def push(remote_path, refname):
+@trace.traced
+def push(remote, refname):
     # Get refs data
-    remote_refs = _get_remote_refs(remote_path)
+    remote_refs = _retry(remote, 'list_refs', lambda connection: connection.list_refs())
     remote_ref = remote_refs.get(refname)
     local_ref = data.get_ref(refname).value
     assert local_ref
@@ -31,22 +60,52 @@ def push(remote_path, refname):
     # Don't allow force push
     assert not remote_ref or base.is_ancestor_of(local_ref, remote_ref), "Force push is not allowed"
 
-    # Compute which objects the server doesn't have
-    known_remote_refs = filter(data.object_exists, remote_refs.values())
-    remote_objects = set(base.iter_objects_in_commits(known_remote_refs))
-    local_objects = set(base.iter_objects_in_commits({local_ref}))
-    objects_to_push = local_objects - remote_objects
+    # Find the commits the server already has, walking back from ours
+    known = [oid for oid in remote_refs.values() if data.object_exists(oid)]
+    common = _retry(remote, 'negotiate',
+                    lambda connection: base.find_common_commits([local_ref], connection.has_objects, known))
 
-    # Push missing objects
-    for oid in objects_to_push:
-        data.push_object(oid, remote_path)
+    # Push everything made since as a single pack
+    with trace.span('remote.find_objects'):
+        objects = list(base.iter_objects_to_send([local_ref], common))
+    trace.count('remote.objects_sent', len(objects))
+    if objects:
+        _retry(remote, 'send_pack', lambda connection: connection.send_pack(objects, base.JOBS, _progress('Sending objects')))
 
     # Update remote ref to ur value
-    with data.change_git_dir(remote_path):
-        data.update_ref(refname,
-                        data.RefValue(symbolic=False, value=local_ref))
+    _retry(remote, 'update_ref', lambda connection: connection.update_ref(refname, local_ref))
+
+
+@trace.traced
+def fetch_missing_objects(oids):
+    remote = data.get_promisor()
+    trace.count('remote.objects_fetched', len(oids))
+    _retry(remote, 'fetch_objects', lambda connection: connection.fetch_objects(oids, base.JOBS, _progress('Fetching objects')))
+
+
+data.fetch_missing = fetch_missing_objects
+
+
+def _retry(remote, name, exchange):
+    # Every exchange can be repeated safely: packs are only installed once complete
+    # and a ref is set to the same value again
+    for attempt in range(1, RETRIES + 1):
+        try:
+            with trace.span(f'remote.{name}'):
+                return exchange(transport.get_transport(remote))
+        except (OSError, EOFError) as e:
+            transport.close_transport(remote)
+            if attempt == RETRIES:
+                raise
+            trace.count('remote.retries')
+            print(f'{e}, retrying ({attempt}/{RETRIES - 1})', file=sys.stderr)
+
 
+def _progress(label):
+    if not sys.stderr.isatty():
+        return None
 
-def _get_remote_refs(remote_path, prefix=''):
-    with data.change_git_dir(remote_path):
-        return {refname: ref.value for refname, ref in data.iter_refs(prefix)}
+    def report(done, total):
+        end = '\n' if done == total else ''
+        print(f'\r{label}: {done * 100 // total}% ({done}/{total})', end=end, file=sys.stderr)
+    return report
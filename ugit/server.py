@@ -0,0 +1,116 @@
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+from . import data, base, types, transport, trace
+from .transport import read_frame, write_frame
+
+# Requests changing the repository run one at a time, reads run concurrently
+_write_lock = threading.Lock()
+
+
+def serve(address: str | tuple[str, int], family=socket.AF_INET):
+    """Serve the repository of the current directory until interrupted"""
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.remove(address)
+        server = _UnixServer(address, _Handler)
+    else:
+        server = _TCPServer(address, _Handler)
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    if family == socket.AF_UNIX:
+        os.remove(address)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # One connection carries any number of requests, answered in order.
+        # A bad request is answered with an error, a lost client ends the session.
+        try:
+            while True:
+                kind, payload = read_frame(self.rfile)
+                trace.count('server.requests')
+                try:
+                    self._dispatch(kind, payload)
+                except (AssertionError, ValueError, KeyError, struct.error) as e:
+                    write_frame(self.wfile, transport.ERROR, str(e).encode())
+                self.wfile.flush()
+        except (EOFError, OSError):
+            pass
+
+    def _dispatch(self, kind, payload):
+        if kind == transport.LIST_REFS:
+            # Other processes may have changed the repository since the last conversation
+            data.reload()
+            refs = data.iter_refs(payload.decode())
+            write_frame(self.wfile, transport.REFS,
+                        ''.join(f'{ref.value} {refname}\n' for refname, ref in refs).encode())
+
+        elif kind == transport.HAVE:
+            found = [oid for oid in transport.decode_oids(payload) if data.object_exists(oid)]
+            write_frame(self.wfile, transport.HAVE, transport.encode_oids(found))
+
+        elif kind == transport.WANT:
+            wants, common, depth, blobs, client_shallow = transport.decode_want(payload)
+            common = [oid for oid in common if data.object_exists(oid)]
+            client_shallow = [oid for oid in client_shallow if data.object_exists(oid)]
+            for oid in wants:
+                assert data.object_exists(oid), f'Unknown object {oid}'
+            objects = list(base.iter_objects_to_send(wants, common, depth, blobs, client_shallow))
+            shallow = base.get_shallow_boundary(wants, common, depth, client_shallow) if depth else set()
+            write_frame(self.wfile, transport.SHALLOW, transport.encode_oids(sorted(shallow)))
+            self._write_pack(objects)
+
+        elif kind == transport.GET_OBJECTS:
+            oids = transport.decode_oids(payload)
+            for oid in oids:
+                assert data.object_exists(oid), f'Unknown object {oid}'
+            self._write_pack(oids)
+
+        elif kind == transport.SEND_PACK:
+            with _write_lock:
+                name = data.receive_pack(transport.iter_stream(self.rfile))
+            write_frame(self.wfile, transport.OK, name.encode())
+
+        elif kind == transport.UPDATE_REF:
+            refname, oid = payload.decode().split(' ')
+            _check_refname(refname)
+            assert data.object_exists(oid), f'Unknown object {oid}'
+            with _write_lock:
+                # Another process may have moved the ref since it was read
+                data.reload()
+                old = data.get_ref(refname).value
+                assert not old or base.is_ancestor_of(oid, old), \
+                    f'Rejected non fast-forward update of {refname} from {old[:10]} to {oid[:10]}'
+                data.update_ref(refname, types.RefValue(symbolic=False, value=oid))
+                base.update_commit_graph([oid])
+            write_frame(self.wfile, transport.OK, b'')
+
+        else:
+            assert False, f'Unknown request {kind!r}'
+
+    def _write_pack(self, oids):
+        chunks = data.iter_pack(oids, base.JOBS) if oids else []
+        transport.write_stream(self.wfile, chunks)
+
+
+def _check_refname(refname: str):
+    # The name becomes a path in the git dir, it mustn't lead out of refs/
+    parts = refname.split('/')
+    assert parts[0] == 'refs' and len(parts) > 1 and '\\' not in refname and '\0' not in refname and \
+        all(part not in ('', '.', '..') for part in parts), f'Invalid ref name {refname}'
@@ -0,0 +1,141 @@
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from typing import Iterable, Iterator
+
+# Set by UGIT_TRACE or --trace: '1' prints a summary to stderr once the command is
+# done, anything else is a file to write a Chrome trace to (chrome://tracing or
+# Perfetto) that also holds the summary and the counters
+OUTPUT = os.environ.get('UGIT_TRACE', '').strip() or None
+if OUTPUT == '0':
+    OUTPUT = None
+ENABLED = OUTPUT is not None
+# Spans kept for the Chrome trace, later ones are only summed up
+MAX_EVENTS = 1_000_000
+
+_lock = threading.Lock()
+_counters: defaultdict[str, int] = defaultdict(int)
+# Calls and total nanoseconds of each span name
+_totals: defaultdict[str, list[int]] = defaultdict(lambda: [0, 0])
+# Name, thread, start and duration in nanoseconds
+_events: list[tuple[str, int, int, int]] = []
+# Names of the spans open in each thread, a recursive call isn't timed twice
+_active = threading.local()
+_start_ns = time.perf_counter_ns()
+_disabled = nullcontext()
+
+
+def enable(output='1'):
+    global ENABLED, OUTPUT
+    ENABLED, OUTPUT = True, output
+
+
+def count(name, n=1):
+    if ENABLED:
+        with _lock:
+            _counters[name] += n
+
+
+def counted(name, items: Iterable) -> Iterator:
+    """Iterate over items, counting them as name"""
+    return _iter_counted(name, items) if ENABLED else iter(items)
+
+
+def _iter_counted(name, items):
+    for item in items:
+        count(name)
+        yield item
+
+
+def span(name):
+    """Context manager timing its block as name"""
+    return _Span(name) if ENABLED else _disabled
+
+
+def traced(func):
+    """Time every call of a function, as a span named after its module and itself"""
+    # A generator would only be timed until its first item
+    assert not inspect.isgeneratorfunction(func), f'{func.__name__} is a generator'
+    name = f'{func.__module__.rpartition(".")[2]}.{func.__name__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        with _Span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class _Span:
+    __slots__ = ('name', 'start', 'outermost')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        names = _active.__dict__.setdefault('names', set())
+        self.outermost = self.name not in names
+        names.add(self.name)
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *_):
+        end = time.perf_counter_ns()
+        if not self.outermost:
+            return
+        _active.names.discard(self.name)
+        with _lock:
+            totals = _totals[self.name]
+            totals[0] += 1
+            totals[1] += end - self.start
+            if len(_events) < MAX_EVENTS:
+                _events.append((self.name, threading.get_ident(), self.start, end - self.start))
+
+
+def summary() -> dict:
+    with _lock:
+        return {
+            'wall_ms': (time.perf_counter_ns() - _start_ns) / 1e6,
+            'spans': {name: {'calls': calls, 'total_ms': total / 1e6}
+                      for name, (calls, total) in sorted(_totals.items(), key=lambda item: -item[1][1])},
+            'counters': dict(sorted(_counters.items())),
+        }
+
+
+def report():
+    """Print the summary or write the trace file, as OUTPUT asks"""
+    if not ENABLED:
+        return
+    if OUTPUT == '1':
+        print_summary()
+    else:
+        write_chrome_trace(OUTPUT)
+
+
+def print_summary(file=sys.stderr):
+    summary_ = summary()
+    print(f'trace: {summary_["wall_ms"]:.1f} ms in total', file=file)
+    for name, span_ in summary_['spans'].items():
+        print(f'trace {name}: {span_["calls"]} calls, {span_["total_ms"]:.1f} ms', file=file)
+    for name, value in summary_['counters'].items():
+        print(f'counter {name}: {value}', file=file)
+
+
+def write_chrome_trace(path):
+    summary_ = summary()
+    pid = os.getpid()
+    with _lock:
+        events = [{'name': name, 'cat': name.partition('.')[0], 'ph': 'X', 'pid': pid, 'tid': thread,
+                   'ts': (start - _start_ns) / 1000, 'dur': duration / 1000}
+                  for name, thread, start, duration in _events]
+    end = summary_['wall_ms'] * 1000
+    events.extend({'name': name, 'ph': 'C', 'pid': pid, 'ts': end, 'args': {'value': value}}
+                  for name, value in summary_['counters'].items())
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': summary_}, f)
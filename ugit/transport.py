@@ -0,0 +1,251 @@
+import contextlib
+import itertools
+import os
+import socket
+import struct
+from typing import Iterable, Iterator
+from urllib.parse import urlsplit
+
+from . import data, base, pack, types, trace
+
+SCHEME = 'ugit'
+DEFAULT_PORT = 9419
+# Oids per have request, several requests are sent before reading any answer
+HAVE_BATCH_SIZE = 256
+CHUNK_SIZE = 64 * 1024
+
+# Every message is a frame of a kind byte and a payload length followed by the
+# payload. Each request gets exactly one response, in order, except pack data
+# which is streamed as data frames closed by an end frame.
+_FRAME = struct.Struct('>cI')
+_WANT = struct.Struct('>IIBI')
+_OID_SIZE = 20
+
+LIST_REFS = b'L'  # prefix -> REFS
+HAVE = b'H'  # oids -> HAVE, the ones the server has
+WANT = b'W'  # counts, depth, blobs, wanted, client's shallow and common oids -> SHALLOW, pack stream
+GET_OBJECTS = b'G'  # oids -> pack stream
+SEND_PACK = b'P'  # followed by a pack stream -> OK
+UPDATE_REF = b'U'  # 'refname oid' -> OK
+REFS = b'R'  # 'oid refname' lines
+SHALLOW = b'S'  # oids of the new shallow commits
+DATA = b'D'
+END = b'E'
+OK = b'O'
+ERROR = b'X'
+
+# Connections are kept open for the rest of the process
+_transports: dict[str, 'LocalTransport | SocketTransport'] = {}
+
+
+def get_transport(remote) -> 'LocalTransport | SocketTransport':
+    transport = _transports.get(remote)
+    if transport is None:
+        if remote.startswith(f'{SCHEME}://'):
+            transport = SocketTransport(remote)
+        else:
+            transport = LocalTransport(remote)
+        _transports[remote] = transport
+    return transport
+
+
+def close_transport(remote):
+    transport = _transports.pop(remote, None)
+    if transport:
+        # Also called once the connection broke, whatever was left unsent is lost anyway
+        with contextlib.suppress(OSError):
+            transport.close()
+
+
+def parse_address(url) -> tuple[int, str | tuple[str, int]]:
+    """ugit://host[:port] for TCP, ugit:///path/to/socket for a Unix socket"""
+    parts = urlsplit(url)
+    assert parts.scheme == SCHEME, f'Not a {SCHEME}:// URL: {url}'
+    if not parts.hostname:
+        assert parts.path, f'No host or socket path in {url}'
+        return socket.AF_UNIX, parts.path
+    return socket.AF_INET, (parts.hostname, parts.port or DEFAULT_PORT)
+
+
+class LocalTransport:
+    """A repository in a directory of this machine"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def list_refs(self, prefix='') -> dict[str, types.OID]:
+        with data.change_git_dir(self.path):
+            return {refname: ref.value for refname, ref in data.iter_refs(prefix)}
+
+    def has_objects(self, oids: list[types.OID]) -> set[types.OID]:
+        with data.change_git_dir(self.path):
+            return {oid for oid in oids if data.object_exists(oid)}
+
+    def fetch_pack(self, wants: list[types.OID], common: Iterable[types.OID], depth: int | None = None,
+                   blobs=True, jobs=1, progress: pack.Progress = None,
+                   shallow: Iterable[types.OID] = ()) -> set[types.OID]:
+        local_path = os.path.dirname(data.GIT_DIR)
+        common, shallow = list(common), list(shallow)
+        with data.change_git_dir(self.path):
+            objects = list(base.iter_objects_to_send(wants, common, depth, blobs, shallow))
+            if objects:
+                data.copy_objects(objects, local_path, jobs, progress)
+            return base.get_shallow_boundary(wants, common, depth, shallow) if depth else set()
+
+    def fetch_objects(self, oids: list[types.OID], jobs=1, progress: pack.Progress = None):
+        local_path = os.path.dirname(data.GIT_DIR)
+        with data.change_git_dir(self.path):
+            data.copy_objects(oids, local_path, jobs, progress)
+
+    def send_pack(self, objects: list[types.OID], jobs=1, progress: pack.Progress = None):
+        data.copy_objects(objects, self.path, jobs, progress)
+
+    def update_ref(self, refname, oid: types.OID):
+        with data.change_git_dir(self.path):
+            data.update_ref(refname, types.RefValue(symbolic=False, value=oid))
+            base.update_commit_graph([oid])
+
+    def close(self):
+        pass
+
+
+class SocketTransport:
+    """A repository served by `ugit serve`"""
+
+    def __init__(self, url):
+        family, address = parse_address(url)
+        if family == socket.AF_UNIX:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(address)
+        else:
+            self._socket = socket.create_connection(address)
+            # Requests are flushed whole, don't hold them back waiting for acks
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._rfile = self._socket.makefile('rb')
+        self._wfile = self._socket.makefile('wb')
+
+    def list_refs(self, prefix='') -> dict[str, types.OID]:
+        payload = self._request(LIST_REFS, prefix.encode(), REFS)
+        return {refname: oid for oid, refname in
+                (line.split(' ', 1) for line in payload.decode().splitlines())}
+
+    def has_objects(self, oids: list[types.OID]) -> set[types.OID]:
+        # Pipelined: all batches go out before the first answer is read
+        batches = [oids[i:i + HAVE_BATCH_SIZE] for i in range(0, len(oids), HAVE_BATCH_SIZE)]
+        for batch in batches:
+            write_frame(self._wfile, HAVE, encode_oids(batch))
+        self._wfile.flush()
+        found = set()
+        for _ in batches:
+            found.update(decode_oids(self._receive(HAVE)))
+        return found
+
+    def fetch_pack(self, wants: list[types.OID], common: Iterable[types.OID], depth: int | None = None,
+                   blobs=True, jobs=1, progress: pack.Progress = None,
+                   shallow: Iterable[types.OID] = ()) -> set[types.OID]:
+        # The server packs with its own parallelism, jobs only applies to sending
+        write_frame(self._wfile, WANT, encode_want(wants, common, depth, blobs, shallow))
+        self._wfile.flush()
+        shallow = set(decode_oids(self._receive(SHALLOW)))
+        self._receive_pack(progress)
+        return shallow
+
+    def fetch_objects(self, oids: list[types.OID], jobs=1, progress: pack.Progress = None):
+        write_frame(self._wfile, GET_OBJECTS, encode_oids(oids))
+        self._wfile.flush()
+        self._receive_pack(progress)
+
+    def send_pack(self, objects: list[types.OID], jobs=1, progress: pack.Progress = None):
+        write_frame(self._wfile, SEND_PACK, b'')
+        write_stream(self._wfile, data.iter_pack(objects, jobs, progress))
+        self._wfile.flush()
+        self._receive(OK)
+
+    def update_ref(self, refname, oid: types.OID):
+        self._request(UPDATE_REF, f'{refname} {oid}'.encode(), OK)
+
+    def close(self):
+        self._rfile.close()
+        self._wfile.close()
+        self._socket.close()
+
+    def _receive_pack(self, progress: pack.Progress):
+        # Nothing to send is an empty stream rather than an empty pack
+        chunks = iter_stream(self._rfile)
+        first = next(chunks, None)
+        if first is not None:
+            data.receive_pack(itertools.chain([first], chunks), progress)
+
+    def _request(self, kind, payload, expected):
+        write_frame(self._wfile, kind, payload)
+        self._wfile.flush()
+        return self._receive(expected)
+
+    def _receive(self, expected) -> bytes:
+        kind, payload = read_frame(self._rfile)
+        assert kind != ERROR, f'Remote error: {payload.decode()}'
+        assert kind == expected, f'Unexpected {kind!r} frame, expected {expected!r}'
+        return payload
+
+
+def read_frame(f) -> tuple[bytes, bytes]:
+    header = f.read(_FRAME.size)
+    if len(header) < _FRAME.size:
+        raise EOFError('Connection closed mid-frame' if header else 'Connection closed')
+    kind, length = _FRAME.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length:
+        raise EOFError('Connection closed mid-frame')
+    trace.count('transport.bytes_received', _FRAME.size + length)
+    return kind, payload
+
+
+def write_frame(f, kind, payload: bytes):
+    trace.count('transport.bytes_sent', _FRAME.size + len(payload))
+    f.write(_FRAME.pack(kind, len(payload)))
+    f.write(payload)
+
+
+def write_stream(f, chunks: Iterable[bytes]):
+    # Coalesce small pack entries into frames of about CHUNK_SIZE
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= CHUNK_SIZE:
+            write_frame(f, DATA, bytes(buffer))
+            buffer.clear()
+    if buffer:
+        write_frame(f, DATA, bytes(buffer))
+    write_frame(f, END, b'')
+
+
+def iter_stream(f) -> Iterator[bytes]:
+    while True:
+        kind, payload = read_frame(f)
+        assert kind != ERROR, f'Remote error: {payload.decode()}'
+        if kind == END:
+            return
+        assert kind == DATA, f'Unexpected {kind!r} frame in pack stream'
+        yield payload
+
+
+def encode_oids(oids: Iterable[types.OID]) -> bytes:
+    return b''.join(bytes.fromhex(oid) for oid in oids)
+
+
+def decode_oids(payload: bytes) -> list[types.OID]:
+    return [payload[i:i + _OID_SIZE].hex() for i in range(0, len(payload), _OID_SIZE)]
+
+
+def encode_want(wants: list[types.OID], common: Iterable[types.OID], depth: int | None, blobs: bool,
+                shallow: Iterable[types.OID] = ()) -> bytes:
+    shallow = list(shallow)
+    return _WANT.pack(len(wants), depth or 0, blobs, len(shallow)) + encode_oids([*wants, *shallow, *common])
+
+
+def decode_want(payload: bytes) -> tuple[list[types.OID], list[types.OID], int | None, bool, list[types.OID]]:
+    count, depth, blobs, shallow_count = _WANT.unpack_from(payload)
+    oids = decode_oids(payload[_WANT.size:])
+    return (oids[:count], oids[count + shallow_count:], depth or None, bool(blobs),
+            oids[count:count + shallow_count])
+
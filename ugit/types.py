@@ -3,6 +3,7 @@ from typing import TypeAlias, NamedTuple, Literal
 Path: TypeAlias = str  # a path in the filesystem
 OID: TypeAlias = str  # hash
 TreeMap: TypeAlias = dict[Path, OID]
+Tree: TypeAlias = TreeMap | OID | None  # a flattened tree, or the oid of a tree object
 ObjectType: TypeAlias = Literal['blob', 'tree', 'commit']
 
 class Commit(NamedTuple):
@@ -11,6 +12,15 @@ class Commit(NamedTuple):
     message: str
 
 
+class IndexEntry(NamedTuple):
+    oid: OID
+    # stat data of the file when it was last hashed, 0 means unknown
+    size: int = 0
+    mtime_ns: int = 0
+    ctime_ns: int = 0
+    ino: int = 0
+
+
 class RefValue(NamedTuple):
     symbolic: bool
     value: OID